@@ -4,9 +4,14 @@
 @date: 2012-09-28
 @author: shell.xu
 '''
-import os, sys, struct, socket, logging
+import os, sys, time, errno, random, struct, socket, select, getopt, logging, collections
 
 DNSSERVER = '8.8.8.8'
+CONNS = 2
+TIMEOUT = 10
+CACHESIZE = 4096
+BATCH = 256
+POLLERR = select.POLLERR | select.POLLHUP | select.POLLNVAL
 
 def initlog(lv, logfile=None):
     rootlog = logging.getLogger()
@@ -19,40 +24,198 @@ def initlog(lv, logfile=None):
     rootlog.addHandler(handler)
     rootlog.setLevel(lv)
 
-def on_datagram(data):
-    sock = socket.socket()
-    try:
-        sock.connect((DNSSERVER, 53))
-        stream = sock.makefile()
-
-        s = struct.pack('!H', len(data))
-        stream.write(s+data)
-        stream.flush()
-
-        s = stream.read(2)
-        if len(s) == 0: raise EOFError()
-        count = struct.unpack('!H', s)[0]
-        reply = stream.read(count)
-        if len(reply) == 0: raise EOFError()
-    finally: sock.close()
-    return reply
-
-def server(port=53):
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', port))
-    logging.info('init DNS Server')
-
+def skipname(d, off):
     while True:
-        data, addr = sock.recvfrom(1024)
-        logging.debug('data come in from %s' % str(addr))
+        c = ord(d[off])
+        if c & 0xC0 == 0xC0: return off + 2
+        if c == 0: return off + 1
+        off += 1 + c
+
+def getttls(d):
+    ''' return (offset, ttl) of all rrs in d, except opt. '''
+    qd, an, ns, ar = struct.unpack_from('>HHHH', d, 4)
+    off, r = 12, []
+    for i in xrange(qd): off = skipname(d, off) + 4
+    for i in xrange(an + ns + ar):
+        off = skipname(d, off)
+        type, cls, ttl, rdlen = struct.unpack_from('>HHIH', d, off)
+        if type != 41: r.append((off + 4, ttl))
+        off += 10 + rdlen
+    if off > len(d): raise Exception('dns response truncated.')
+    return r
+
+def recvbatch(sock):
+    ''' read at most BATCH datagrams, until the socket is drained. '''
+    for i in xrange(BATCH):
+        try: yield sock.recvfrom(1024)
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            raise
+
+class Upstream(object):
+    ''' a persistent tcp connection to dns server, queries are pipelined on it.
+    it connects when the first query comes, and again after it closed. '''
+
+    def __init__(self, proxy):
+        self.proxy, self.sock, self.ids = proxy, None, set()
+
+    def connect(self):
+        self.sock = socket.socket()
+        self.sock.setblocking(0)
+        self.sock.connect_ex(self.proxy.server)
+        self.rbuf, self.wbuf, self.answered = '', '', 0
+        self.proxy.poll.register(self.sock.fileno(), select.POLLIN | select.POLLOUT)
+        self.proxy.fdmap[self.sock.fileno()] = self.on_event
+
+    def send(self, id, data):
+        if self.sock is None: self.connect()
+        self.ids.add(id)
+        self.wbuf += struct.pack('>H', len(data)) + data
+        self.proxy.poll.modify(self.sock.fileno(), select.POLLIN | select.POLLOUT)
+
+    def on_event(self, ev):
         try:
-            r = on_datagram(data)
-            if r is None: continue
-            sock.sendto(r, addr)
-        except Exception, err: logging.exception(err)
+            if ev & POLLERR: raise EOFError()
+            if ev & select.POLLOUT and self.wbuf:
+                self.wbuf = self.wbuf[self.sock.send(self.wbuf):]
+            if not self.wbuf: self.proxy.poll.modify(self.sock.fileno(), select.POLLIN)
+            if ev & select.POLLIN:
+                d = self.sock.recv(65536)
+                if not d: raise EOFError()
+                self.rbuf += d
+                while len(self.rbuf) >= 2:
+                    l = struct.unpack_from('>H', self.rbuf)[0] + 2
+                    if len(self.rbuf) < l: break
+                    d, self.rbuf = self.rbuf[2:l], self.rbuf[l:]
+                    self.ids.discard(struct.unpack_from('>H', d)[0])
+                    self.answered += 1
+                    self.proxy.on_answer(d)
+        except socket.error, err:
+            if err.errno not in (errno.EAGAIN, errno.EWOULDBLOCK): self.close()
+        except EOFError: self.close()
+
+    def close(self):
+        fd = self.sock.fileno()
+        self.proxy.poll.unregister(fd)
+        del self.proxy.fdmap[fd]
+        self.sock.close()
+        self.sock, ids, self.ids = None, self.ids, set()
+        if ids: logging.info('dns connection broken with %d queries' % len(ids))
+        self.proxy.broken(ids, self.answered > 0)
+
+class DNS2TCP(object):
+    ''' forward udp queries to dns server over a few tcp connections.
+    answers are matched by remapped id and cached by ttl. '''
+
+    def __init__(self, port=53, server=(DNSSERVER, 53), conns=CONNS, cachesize=CACHESIZE):
+        self.server, self.cachesize = server, cachesize
+        # id: (addr, client id, data, deadline, resent), deadline ordered.
+        self.inquery = collections.OrderedDict()
+        # question: (expire, time, answer, ttls), insertion ordered.
+        self.cache = collections.OrderedDict()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('', port))
+        self.sock.setblocking(0)
+        self.poll = select.poll()
+        self.poll.register(self.sock.fileno(), select.POLLIN)
+        self.fdmap = {self.sock.fileno(): lambda ev: self.on_query()}
+        self.conns = [Upstream(self) for i in xrange(conns)]
+
+    def newid(self):
+        if len(self.inquery) >= 0xffff: return None
+        id = random.randint(0, 0xffff)
+        while id in self.inquery: id = random.randint(0, 0xffff)
+        return id
+
+    def send(self, id, data):
+        min(self.conns, key=lambda c: len(c.ids)).send(id, struct.pack('>H', id) + data)
+
+    def on_query(self):
+        deadline = time.time() + TIMEOUT
+        for data, addr in recvbatch(self.sock):
+            if len(data) < 12: continue
+            r = self.getcache(data)
+            if r is not None:
+                self.sock.sendto(r, addr)
+                continue
+            id = self.newid()
+            if id is None: continue
+            self.inquery[id] = (addr, data[:2], data[2:], deadline, False)
+            self.send(id, data[2:])
+
+    def on_answer(self, d):
+        q = self.inquery.pop(struct.unpack_from('>H', d)[0], None)
+        if q is None: return
+        self.sock.sendto(q[1] + d[2:], q[0])
+        self.setcache(q[2][10:], d)
+
+    def broken(self, ids, answered):
+        ''' send queries on a broken connection again. if it answered nothing,
+        those sent again already are dropped, so a dead server never loops. '''
+        for id in ids:
+            q = self.inquery.get(id)
+            if q is None or (q[4] and not answered): continue
+            self.inquery[id] = q[:4] + (True,)
+            self.send(id, q[2])
+
+    def getcache(self, data):
+        ''' return answer of query data from cache, ttl decreased, or None. '''
+        r = self.cache.get(data[12:])
+        if r is None: return
+        t = time.time()
+        if r[0] <= t:
+            del self.cache[data[12:]]
+            return
+        d, age = bytearray(r[2]), int(t - r[1])
+        d[:2] = data[:2]
+        for off, ttl in r[3]: struct.pack_into('>I', d, off, max(ttl - age, 0))
+        return str(d)
+
+    def setcache(self, quiz, d):
+        ''' cache answers with no error or no such name, until the first rr
+        expired. those without rr are not cached. '''
+        if struct.unpack_from('>H', d, 2)[0] & 0x020f not in (0, 3): return
+        try: ttls = getttls(d)
+        except Exception, err: return
+        if not ttls: return
+        ttl = min(ttl for off, ttl in ttls)
+        if ttl <= 0: return
+        t = time.time()
+        self.cache.pop(quiz, None)
+        while len(self.cache) >= self.cachesize: self.cache.popitem(False)
+        self.cache[quiz] = (t + ttl, t, d, ttls)
+
+    def expire(self):
+        t, ids = time.time(), []
+        for id, q in self.inquery.iteritems():
+            if q[3] > t: break
+            ids.append(id)
+        for id in ids: del self.inquery[id]
+        if ids: logging.info('%d dns queries timeout' % len(ids))
+
+    def run(self):
+        logging.info('init DNS Server')
+        while True:
+            try:
+                for fd, ev in self.poll.poll(1000): self.fdmap[fd](ev)
+                self.expire()
+            except Exception, err: logging.exception(err)
 
 def main():
+    '''
+    -h: help
+    -p: port, 53 by default
+    -s: dns server, ip or ip:port, 8.8.8.8 by default
+    -c: tcp connections to dns server, 2 by default
+    '''
+    optlist, args = getopt.getopt(sys.argv[1:], 'hp:s:c:')
+    optdict = dict(optlist)
+    if '-h' in optdict:
+        print main.__doc__
+        return
+    server = optdict.get('-s', DNSSERVER).split(':', 1)
+    server = (server[0], int(server[1]) if len(server) > 1 else 53)
     initlog(logging.DEBUG)
-    server()
+    DNS2TCP(int(optdict.get('-p', 53)), server, int(optdict.get('-c', CONNS))).run()
 
 if __name__ == '__main__': main()
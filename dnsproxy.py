@@ -4,14 +4,19 @@
 @date: 2012-10-29
 @author: shell.xu
 '''
-import os, sys, time, socket, select, logging
+import os, sys, time, errno, random, struct, getopt, signal, logging, collections
 
 sys.path.append('uniproxy')
 from mydns import *
+# mydns brings gevent's socket in, we need the plain one.
+import socket, select
 
-inquery = {}
 DNSSERVER = '8.8.8.8'
 TIMEOUT = 60
+NEGATIVE = 300
+CACHESIZE = 4096
+BATCH = 256
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 fakeset = set([
         '8.7.198.45', '37.61.54.158',
         '46.82.174.68', '59.24.3.173',
@@ -19,51 +24,151 @@ fakeset = set([
         '159.106.121.75', '203.98.7.65',
         '243.185.187.39'])
 
-def on_query():
-    data, addr = sock.recvfrom(1024)
-    q = Record.unpack(data)
-    if q.id not in inquery:
-        inquery[q.id] = (addr, time.time())
-        client.sendto(data, (DNSSERVER, 53))
-    else: logging.warn('dns id %d is conflict.' % q.id)
-
-def on_answer():
-    data, addr = client.recvfrom(1024)
-    r = Record.unpack(data)
-    if r.id in inquery:
-        addr, ti = inquery[r.id]
-        if not get_ipaddrs(r): return
-        sock.sendto(data, addr)
-        del inquery[r.id]
-    else: logging.warn('dns server return a record id %d but no one care.' % r.id)
-
 def get_ipaddrs(r):
-    ipaddrs = [rdata for name, type, cls, ttl, rdata in r.ans if type == TYPE.A]
+    ''' return addresses of the type in quiz, None to drop r.
+    no such name, or no address of the type, is a valid empty answer. '''
+    qtype = r.quiz[0][1] if r.quiz else TYPE.A
+    # mx and soa rrs have more fields, any type may come here.
+    ipaddrs = [rr[4] for rr in r.ans if rr[1] == qtype]
     if not ipaddrs:
-        logging.info('drop an empty dns response.')
+        if r.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN): return ipaddrs
+        logging.info('drop an empty dns response with rcode %d.' % r.rcode)
     elif fakeset & set(ipaddrs):
         logging.info('drop %s for fakeset.' % ipaddrs)
     else: return ipaddrs
 
-def on_idle():
-    t = time.time()
-    rlist = [k for k, v in inquery.iteritems() if t - v[1] > TIMEOUT]
-    for k in rlist: del inquery[k]
+def recvbatch(sock):
+    ''' read at most BATCH datagrams, until the socket is drained. '''
+    for i in xrange(BATCH):
+        try: yield sock.recvfrom(1024)
+        except socket.error, err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK): return
+            raise
+
+class DNSProxy(object):
+    ''' one worker. queries are forwarded upstream with ids remapped,
+    pending ones are kept in the order they come, which is the order
+    they expire too, as all of them have the same timeout.
+    negative answers are cached for NEGATIVE seconds, by the question. '''
+
+    def __init__(self, port=53, server=(DNSSERVER, 53)):
+        # id: (addr, client id, deadline, question), deadline ordered.
+        self.server, self.inquery = server, collections.OrderedDict()
+        # question: (expire, answer without id), insertion ordered.
+        self.cache = collections.OrderedDict()
+        self.stats = dict.fromkeys(['query', 'answer', 'cached', 'drop', 'timeout'], 0)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.sock.bind(('', port))
+        self.sock.setblocking(0)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.setblocking(0)
+
+    def newid(self):
+        if len(self.inquery) >= 0xffff: return None
+        id = random.randint(0, 0xffff)
+        while id in self.inquery: id = random.randint(0, 0xffff)
+        return id
+
+    def on_query(self):
+        deadline = time.time() + TIMEOUT
+        for data, addr in recvbatch(self.sock):
+            if len(data) < 12: continue
+            d = self.getcache(data[12:])
+            if d is not None:
+                self.stats['cached'] += 1
+                self.sock.sendto(data[:2] + d, addr)
+                continue
+            id = self.newid()
+            if id is None:
+                self.stats['drop'] += 1
+                continue
+            self.stats['query'] += 1
+            self.inquery[id] = (addr, data[:2], deadline, data[12:])
+            self.client.sendto(struct.pack('>H', id) + data[2:], self.server)
+
+    def on_answer(self):
+        for data, addr in recvbatch(self.client):
+            if len(data) < 12: continue
+            id = struct.unpack_from('>H', data)[0]
+            q = self.inquery.get(id)
+            if q is None:
+                logging.debug('dns server return a record id %d but no one care.' % id)
+                continue
+            ipaddrs = get_ipaddrs(Record.unpack(data, PARSE.ANSWER))
+            if ipaddrs is None: continue
+            del self.inquery[id]
+            self.stats['answer'] += 1
+            self.sock.sendto(q[1] + data[2:], q[0])
+            if not ipaddrs: self.setcache(q[3], data[2:])
+
+    def getcache(self, quiz):
+        r = self.cache.get(quiz)
+        if r is None: return
+        if r[0] <= time.time():
+            del self.cache[quiz]
+            return
+        return r[1]
+
+    def setcache(self, quiz, d):
+        self.cache.pop(quiz, None)
+        while len(self.cache) >= CACHESIZE: self.cache.popitem(False)
+        self.cache[quiz] = (time.time() + NEGATIVE, d)
+
+    def expire(self):
+        t, ids = time.time(), []
+        for id, q in self.inquery.iteritems():
+            if q[2] > t: break
+            ids.append(id)
+        for id in ids: del self.inquery[id]
+        self.stats['timeout'] += len(ids)
+
+    def run(self):
+        ep = select.epoll()
+        fdmap = {self.sock.fileno(): self.on_query, self.client.fileno(): self.on_answer}
+        for fd in fdmap.keys(): ep.register(fd, select.EPOLLIN)
+        logging.info('init dns server')
+        while True:
+            try:
+                for fd, ev in ep.poll(1): fdmap[fd]()
+                self.expire()
+            except Exception, err: logging.exception('unknown')
+
+def worker(port, server):
+    signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+    DNSProxy(port, server).run()
 
 def main():
-    global sock, client
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('', 53))
-    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    logging.info('init dns server')
-
-    poll = select.poll()
-    fdmap = {sock.fileno(): on_query, client.fileno(): on_answer}
-    for fd in fdmap.keys(): poll.register(fd, select.POLLIN)
-    while True:
-        try:
-            for fd, ev in poll.poll(60): fdmap[fd]()
-            on_idle()
-        except Exception, err: logging.exception('unknown')
+    '''
+    -h: help
+    -p: port, 53 by default
+    -s: dns server, ip or ip:port, 8.8.8.8 by default
+    -w: worker processes sharing the port, 1 by default
+    '''
+    optlist, args = getopt.getopt(sys.argv[1:], 'hp:s:w:')
+    optdict = dict(optlist)
+    if '-h' in optdict:
+        print main.__doc__
+        return
+    server = optdict.get('-s', DNSSERVER).split(':', 1)
+    server = (server[0], int(server[1]) if len(server) > 1 else 53)
+    port, workers = int(optdict.get('-p', 53)), int(optdict.get('-w', 1))
+    if workers == 1: return worker(port, server)
+
+    pids = []
+    for i in xrange(workers):
+        pid = os.fork()
+        if pid == 0:
+            try: worker(port, server)
+            finally: os._exit(0)
+        pids.append(pid)
+    def stop(signum, frame):
+        for pid in pids:
+            try: os.kill(pid, signal.SIGTERM)
+            except OSError: pass
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for pid in pids: os.waitpid(pid, 0)
+    except (OSError, KeyboardInterrupt): stop(None, None)
 
 if __name__ == '__main__': main()
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+@remark: 性能测试，用法：python bench.py netfilter ...
+'''
+import sys, time, random, struct
+
+sys.path.append("../uniproxy")
+
+def timeit(name, func, count):
+    t = time.time()
+    func()
+    t = time.time() - t
+    print '%s: %d in %0.3fs, %0.0f/s' % (name, count, t, count / t)
+
+def randips(count):
+    return [struct.pack('>L', random.randint(0, 0xffffffff)) for i in xrange(count)]
+
+def bench_netfilter(filename='../data/routes.list.gz', count=100000):
+    import netfilter
+    nf = netfilter.NetFilter(filename)
+    ips = randips(count)
+    def old():
+        for addr in ips:
+            for mask, addrs in nf.nets.iteritems():
+                if netfilter.get_netaddr(addr, mask) in addrs: break
+    def new():
+        for addr in ips: addr in nf
+    timeit('netfilter mask scan', old, count)
+    timeit('netfilter bisect', new, count)
+
+def bench_nfload(filename='../data/routes.list.gz'):
+    import os, tempfile, netfilter
+    binpath = os.path.join(tempfile.mkdtemp(), 'routes.bin')
+    netfilter.NetFilter(filename).compile(binpath)
+    timeit('netfilter text load', lambda: netfilter.NetFilter(filename), 1)
+    timeit('netfilter binary load', lambda: netfilter.NetFilter().loadbinary(binpath), 1)
+    os.remove(binpath)
+
+def bench_contains_many(filename='../data/routes.list.gz', count=1000000):
+    import netfilter
+    nf = netfilter.NetFilter(filename)
+    ips = [random.randint(0, 0xffffffff) for i in xrange(count)]
+    def single():
+        for ip in ips: nf.ipint_in(ip)
+    timeit('netfilter single lookup', single, count)
+    timeit('netfilter contains_many', lambda: nf.contains_many(ips), count)
+    if netfilter.numpy is not None:
+        arr = netfilter.numpy.array(ips, netfilter.numpy.uint32)
+        timeit('netfilter contains_many array', lambda: nf.contains_many(arr), count)
+
+def bench_trie6(count=50000):
+    import netfilter
+    prefixes = []
+    for i in xrange(count):
+        plen = random.randint(19, 48)
+        prefixes.append((random.getrandbits(plen) << (128 - plen), plen))
+    trie = netfilter.PrefixTrie()
+    timeit('ipv6 trie bulk load', lambda: trie.build(prefixes), count)
+    keys = [random.getrandbits(128) for i in xrange(count)]
+    def lookup():
+        for key in keys: key in trie
+    timeit('ipv6 trie lookup', lookup, count)
+
+def sizeof(o, seen=None):
+    if seen is None: seen = set()
+    if id(o) in seen: return 0
+    seen.add(id(o))
+    n = sys.getsizeof(o)
+    if isinstance(o, dict):
+        n += sum(sizeof(k, seen) + sizeof(v, seen) for k, v in o.iteritems())
+    elif isinstance(o, (list, tuple, set)): n += sum(sizeof(i, seen) for i in o)
+    return n
+
+class DictTrie(object):
+    ''' the nested dict DomainFilter, as a baseline. '''
+    def __init__(self): self.domains = {}
+    def add(self, domain):
+        doptr, chunk = self.domains, domain.split('.')
+        for c in reversed(chunk):
+            if len(c.strip()) == 0: continue
+            if c not in doptr or doptr[c] is None: doptr[c] = {}
+            lastptr, doptr = doptr, doptr[c]
+        if len(doptr) == 0: lastptr[c] = None
+    def __contains__(self, domain):
+        doptr, chunk = self.domains, domain.split('.')
+        for c in reversed(chunk):
+            if len(c.strip()) == 0: continue
+            if c not in doptr: return False
+            doptr = doptr[c]
+            if doptr is None: break
+        return doptr is None
+
+def randdomain():
+    labels = [''.join(random.choice('abcdefghijklmnopqrstuvwxyz')
+                      for i in xrange(random.randint(3, 10)))
+              for j in xrange(random.randint(1, 3))]
+    return '.'.join(labels + [random.choice(['com', 'net', 'org', 'co.uk'])])
+
+def bench_dofilter(count=50000, lookups=200000):
+    import dofilter
+    domains = [randdomain() for i in xrange(count)]
+    hosts = ['www.' + random.choice(domains) if i % 2 else randdomain()
+             for i in xrange(lookups)]
+    for name, f in [('nested dict', DictTrie()), ('suffix set', dofilter.DomainFilter())]:
+        timeit('dofilter %s load' % name, lambda: map(f.add, domains), count)
+        def lookup():
+            for h in hosts: h in f
+        timeit('dofilter %s lookup' % name, lookup, lookups)
+        print 'dofilter %s memory: %0.1f MB' % (name, sizeof(f.domains) / 1048576.0)
+
+def bench_tcpdns(count=2000, concurrency=50, delay=0.02):
+    import gevent, mydns, dnsserver, tcpdns
+    from gevent import server, pool
+    srv = server.StreamServer(('127.0.0.1', 0), tcpdns.stub_handle(1000000, delay))
+    srv.start()
+    addr = ('127.0.0.1', srv.server_port)
+    def oneshot(i):
+        # the same as mydns.query_by_tcp, which is fixed to port 53.
+        sock = gevent.socket.create_connection(addr)
+        try: mydns.query_by_tcp(mydns.mkquery(('h%d.com' % i, 1)).pack(), None, sock.makefile())
+        finally: sock.close()
+    dns = dnsserver.TCPDNSServer([addr], tcpdns.PlainManager(), timeout=30)
+    def pipelined(i): dns.do_query('h%d.com' % i)
+    for name, func in [('connection per query', oneshot), ('pipelined', pipelined)]:
+        timeit('tcpdns %s' % name, lambda: pool.Pool(concurrency).map(func, xrange(count)), count)
+    dns.stop()
+    srv.stop()
+
+def bench_dnsparse(count=100000):
+    from mydns import Record, PARSE, OPCODE, TYPE, CLASS
+    r = Record(1234, 1, OPCODE.QUERY, 0, 0, 1, 1, 0)
+    r.quiz = [('www.example.com', TYPE.A, CLASS.IN)]
+    r.ans = [('www.example.com', TYPE.CNAME, CLASS.IN, 300, 'www.example.com.cdn.net')] + \
+        [('www.example.com.cdn.net', TYPE.A, CLASS.IN, 60, '10.0.0.%d' % i) for i in xrange(4)]
+    r.auth = [('cdn.net', TYPE.SOA, CLASS.IN, 60, 'ns1.cdn.net', 'hostmaster.cdn.net',
+               1, 2, 3, 4, 5)]
+    d = r.pack()
+    for level in [PARSE.ALL, PARSE.ANSWER, PARSE.HEADER]:
+        def parse():
+            for i in xrange(count): Record.unpack(d, level)
+        timeit('dnsparse %s' % PARSE.lookup(level), parse, count)
+
+def main():
+    for name in sys.argv[1:] or ['netfilter']: globals()['bench_' + name]()
+
+if __name__ == '__main__': main()
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, unittest, gevent
+from gevent import server, socket
+
+sys.path.append("../uniproxy")
+import conn, socks
+
+class Sock(socket.socket): pass
+
+class ManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.srv = server.StreamServer(('127.0.0.1', 0), lambda sock, addr: sock.recv(1))
+        self.srv.start()
+        self.addr = ('127.0.0.1', self.srv.server_port)
+        self.mgr = conn.Manager(2, 'test')
+
+    def tearDown(self): self.srv.stop()
+
+    def test_reuse(self):
+        sock, reused = self.mgr.acquire(self.addr)
+        self.mgr.release(self.addr, sock, True)
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (1, 1))
+        self.assertEqual(self.mgr.acquire(self.addr), (sock, True))
+        self.assertEqual((self.mgr.hit, self.mgr.miss), (1, 1))
+
+    def test_handoff(self):
+        socks = [self.mgr.acquire(self.addr)[0] for i in xrange(2)]
+        gr = gevent.spawn(self.mgr.acquire, self.addr)
+        gevent.sleep(0)
+        self.assertEqual(self.mgr.waiting(), 1)
+        for sock in socks: self.mgr.release(self.addr, sock, True)
+        sock, reused = gr.get(timeout=1)
+        self.assertFalse(reused)
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (1, 0))
+
+    def test_closed(self):
+        sock, reused = self.mgr.acquire(self.addr)
+        self.mgr.release(self.addr, sock, True)
+        sock.send('x') # peer closes after reading one byte
+        gevent.sleep(0.05)
+        s, reused = self.mgr.acquire(self.addr)
+        self.assertFalse(reused)
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (1, 0))
+
+    def test_evict(self):
+        socks = [self.mgr.acquire(self.addr)[0] for i in xrange(2)]
+        for sock in socks: self.mgr.release(self.addr, sock, True)
+        sock, reused = self.mgr.acquire(self.addr)
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (2, 1))
+        with gevent.Timeout(1):
+            with self.mgr.socket() as s: pass
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (1, 0))
+
+    def test_no_overload(self):
+        self.mgr.MAX_QUEUE, self.mgr.WAIT = 0, 0.1
+        socks = [self.mgr.acquire(self.addr)[0] for i in xrange(2)]
+        for sock in socks: self.mgr.release(self.addr, sock, True)
+        with gevent.Timeout(1): self.mgr.wait()
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (2, 1))
+        self.mgr.wait()
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (2, 0))
+        self.assertRaises(conn.Overload, self.mgr.wait)
+
+    def test_prune(self):
+        sock, reused = self.mgr.acquire(self.addr)
+        self.mgr.release(self.addr, sock, True)
+        self.mgr.IDLE = 0
+        gevent.sleep(0.01)
+        self.mgr.wait()
+        self.assertEqual((self.mgr.size(), self.mgr.nidle), (1, 0))
+
+    def test_nodns(self):
+        mgr = conn.DirectManager(None)
+        sock, reused = mgr.acquire(('localhost', self.addr[1]))
+        self.assertEqual(sock.getpeername()[1], self.addr[1])
+        mgr.release(self.addr, sock)
+        self.assertEqual(mgr.count, 0)
+        self.assertRaises(Exception, mgr.acquire, ('nonexistent.invalid', 80))
+
+class WarmTest(unittest.TestCase):
+    def setUp(self):
+        self.srv = server.StreamServer(('127.0.0.1', 0), lambda sock, addr: sock.recv(1))
+        self.srv.start()
+        self.mgr = self.manager(10)
+        self.greets = 0
+
+    def manager(self, max_conn):
+        mgr = socks.SocksManager('127.0.0.1', self.srv.server_port, max_conn=max_conn, warm=2)
+        def greet(*p):
+            self.greets += 1
+            gevent.sleep(0.01)
+            sock = Sock()
+            sock.connect(('127.0.0.1', self.srv.server_port))
+            return sock
+        mgr.greet = greet
+        return mgr
+
+    def tearDown(self): self.srv.stop()
+
+    def test_burst(self):
+        gevent.joinall([gevent.spawn(self.mgr.create) for i in xrange(10)])
+        gevent.sleep(0.05)
+        self.assertEqual((self.mgr.warm_hit, self.mgr.warm_miss), (0, 10))
+        self.assertEqual((len(self.mgr.warmed), self.greets), (2, 12))
+        self.mgr.create()
+        self.assertEqual(self.mgr.warm_hit, 1)
+        gevent.sleep(0.05)
+        self.assertEqual((len(self.mgr.warmed), self.greets), (2, 13))
+
+    def test_stale(self):
+        self.mgr.refill()
+        gevent.sleep(0.05)
+        self.assertEqual(len(self.mgr.warmed), 2)
+        self.mgr.warmed[0][1].send('x') # closed by proxy
+        self.mgr.warmed[1] = (0, self.mgr.warmed[1][1]) # warmed too long ago
+        gevent.sleep(0.05)
+        self.mgr.create()
+        self.assertEqual((self.mgr.warm_hit, self.mgr.warm_miss), (0, 1))
+        gevent.sleep(0.05)
+        self.assertEqual((len(self.mgr.warmed), self.greets), (2, 5))
+
+    def test_cap(self):
+        mgr = self.manager(2)
+        mgr.wait()
+        mgr.create()
+        gevent.sleep(0.05)
+        self.assertEqual((len(mgr.warmed), self.greets), (1, 2))
+        mgr.wait()
+        mgr.free()
+        gevent.sleep(0.05)
+        self.assertEqual((len(mgr.warmed), self.greets), (1, 2))
+        mgr.wait()
+        mgr.create()
+        self.assertEqual(mgr.warm_hit, 1)
+        gevent.sleep(0.05)
+        self.assertEqual((len(mgr.warmed), self.greets), (0, 2))
+        mgr.free()
+        gevent.sleep(0.05)
+        self.assertEqual((len(mgr.warmed), self.greets), (1, 3))
+
+class FakeSock(object):
+    def __init__(self, err): self.err = err
+    def connect(self, addr): raise self.err
+    def close(self): pass
+
+class HangSock(FakeSock):
+    def connect(self, addr): gevent.sleep(3600)
+
+class HealthTest(unittest.TestCase):
+    def fails(self, mgr, err, n=3):
+        mgr.creator = lambda *p: FakeSock(err)
+        for i in xrange(n): self.assertRaises(type(err), mgr.acquire, ('example.com', 80))
+
+    def test_target(self):
+        mgr = socks.SocksManager('127.0.0.1', 1080)
+        self.fails(mgr, socks.Socks5Error(4))
+        self.assertFalse(mgr.ejected())
+        self.assertEqual(mgr.errors, 0)
+        self.fails(mgr, socks.Socks5Error(1))
+        self.assertTrue(mgr.ejected())
+        self.assertEqual(mgr.size(), 0)
+
+    def test_probe(self):
+        mgr = conn.Manager(2, 'test')
+        self.fails(mgr, EOFError())
+        self.assertTrue(mgr.ejected())
+        mgr.until = 0
+        self.assertFalse(mgr.ejected())
+        mgr.picked()
+        self.assertTrue(mgr.ejected())
+        mgr.report(connrtt=0.01)
+        self.assertFalse(mgr.ejected())
+        self.assertEqual(mgr.eject, mgr.EJECT)
+
+    def test_hang(self):
+        mgr = socks.SocksManager('127.0.0.1', 1080)
+        mgr.CONNECT = 0.05
+        mgr.creator = lambda *p: HangSock(None)
+        for i in xrange(mgr.FAILS):
+            self.assertRaises(gevent.Timeout, mgr.acquire, ('example.com', 80))
+        self.assertTrue(mgr.ejected())
+        self.assertEqual(mgr.size(), 0)
+
+    def test_direct(self):
+        self.assertFalse(isinstance(conn.DirectManager(None), conn.Health))
+
+class OverloadTest(unittest.TestCase):
+    def setUp(self):
+        self.mgr = conn.Manager(1, 'test')
+        self.mgr.creator = lambda: None
+        self.mgr.MAX_QUEUE, self.mgr.WAIT = 1, 0.1
+        self.mgr.wait()
+
+    def test_queue_full(self):
+        gr = gevent.spawn(self.mgr.wait)
+        gevent.sleep(0)
+        self.assertRaises(conn.Overload, self.mgr.wait)
+        self.assertRaises(conn.Overload, gr.get)
+        self.assertEqual(self.mgr.waiting(), 0)
+
+    def test_timeout(self):
+        gr = gevent.spawn(self.mgr.wait)
+        gevent.sleep(0.05)
+        self.mgr.free()
+        gr.get(timeout=1)
+        self.assertRaises(conn.Overload, self.mgr.wait)
+        self.assertTrue(self.mgr.waits[-1] >= 0.1)
+        self.assertTrue('queue 0/1' in self.mgr.stat())
@@ -0,0 +1,120 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, time, shutil, tempfile, unittest, gevent
+from os import path
+from gevent import server
+
+sys.path.append("../uniproxy")
+import dnsserver
+from mydns import *
+from tcpdns import reply
+
+class UpstreamCase(unittest.TestCase):
+    ''' a udp upstream answering after delay, counting queries. '''
+    delay = 0.05
+
+    def setUp(self):
+        self.count = 0
+        def handle(d, addr):
+            self.count += 1
+            gevent.sleep(self.delay)
+            self.udp.sendto(reply(d), addr)
+        self.udp = server.DatagramServer(('127.0.0.1', 0), handle)
+        self.udp.start()
+        self.dns = dnsserver.DNSServer([('127.0.0.1', self.udp.server_port)], timeout=5)
+
+    def tearDown(self):
+        self.dns.stop()
+        self.udp.stop()
+
+class SingleFlightTest(UpstreamCase):
+    def test_coalesce(self):
+        grs = [gevent.spawn(self.dns.gethostbyname, 'a.com') for i in xrange(10)]
+        gevent.joinall(grs, timeout=5)
+        self.assertEqual([gr.value for gr in grs], ['1.2.3.4'] * 10)
+        self.assertEqual(self.count, 1)
+        self.assertEqual((self.dns.stats['upstream'], self.dns.stats['coalesced']), (1, 9))
+
+    def test_error(self):
+        calls = []
+        def do_query(name, type):
+            calls.append(name)
+            gevent.sleep(0.05)
+            raise Exception('upstream failed')
+        self.dns.do_query = do_query
+        grs = [gevent.spawn(self.dns.query, 'b.com') for i in xrange(5)]
+        gevent.joinall(grs, timeout=5)
+        self.assertEqual(calls, ['b.com'])
+        self.assertEqual([str(gr.exception) for gr in grs], ['upstream failed'] * 5)
+        self.assertEqual(self.dns.inflight, {})
+
+class RefreshTest(UpstreamCase):
+    def stale(self, name, age):
+        self.dns.setcache(name, ['9.9.9.9'], 60)
+        self.dns.cache.get((name, TYPE.A))[0] = time.time() - age
+
+    def test_hot(self):
+        self.dns.setcache('hot.com', ['9.9.9.9'], 10)
+        for i in xrange(self.dns.HOTHITS): self.assertEqual(self.dns.gethostbyname('hot.com'), '9.9.9.9')
+        gevent.sleep(0.1)
+        self.assertEqual(self.count, 1)
+        self.assertEqual(self.dns.stats['refresh'], 1)
+        self.assertEqual(self.dns.gethostbyname('hot.com'), '1.2.3.4')
+
+    def test_grace(self):
+        self.stale('grace.com', 5)
+        self.assertEqual(self.dns.gethostbyname('grace.com'), '9.9.9.9')
+        self.assertEqual(self.dns.gethostbyname('grace.com'), '9.9.9.9')
+        self.assertEqual(self.dns.stats['grace'], 2)
+        gevent.sleep(0.1)
+        self.assertEqual(self.count, 1)
+        self.assertEqual(self.dns.gethostbyname('grace.com'), '1.2.3.4')
+
+    def test_past_grace(self):
+        self.stale('old.com', self.dns.GRACE + 1)
+        t = time.time()
+        self.assertEqual(self.dns.gethostbyname('old.com'), '1.2.3.4')
+        self.assertTrue(time.time() - t >= self.delay)
+        self.assertEqual((self.count, self.dns.stats['grace']), (1, 0))
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dns = dnsserver.DNSServer([('127.0.0.1', 53)], timeout=5)
+
+    def tearDown(self):
+        self.dns.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        filepath = path.join(self.tmpdir, 'dns', 'snapshot.gz')
+        self.dns.setcache('a.com', ['1.2.3.4', '5.6.7.8'], 60)
+        self.dns.setcache('none.com', [], 60, rcode=RCODE.NXDOMAIN)
+        self.dns.setcache('a.com', ['::1'], 60, type=TYPE.AAAA)
+        self.assertTrue(self.dns.savesnapshot(filepath))
+        dns = dnsserver.DNSServer([('127.0.0.1', 53)], timeout=5)
+        try:
+            self.assertTrue(dns.loadsnapshot(filepath))
+            for key in [('a.com', TYPE.A), ('none.com', TYPE.A), ('a.com', TYPE.AAAA)]:
+                r1, r2 = self.dns.cache.get(key), dns.cache.get(key)
+                self.assertEqual((r2[1], r2[4]), (r1[1], r1[4]))
+                self.assertTrue(abs(r2[5] - r1[5]) < 1)
+        finally: dns.stop()
+
+    def test_missing(self):
+        self.assertFalse(self.dns.loadsnapshot(path.join(self.tmpdir, 'none')))
+
+    def test_corrupt(self):
+        filepath = path.join(self.tmpdir, 'snapshot')
+        with open(filepath, 'w') as fo:
+            fo.write('broken\nbad.com\tnotime\t1.1.1.1\n')
+            fo.write('good.com\t%0.0f\t1.1.1.1\t1\t0\t%0.0f\n' % (time.time() + 60, time.time() + 60))
+        self.assertTrue(self.dns.loadsnapshot(filepath))
+        self.assertEqual(self.dns.cache.get(('good.com', TYPE.A))[1], ['1.1.1.1'])
+        self.assertEqual(self.dns.cache.get(('bad.com', TYPE.A)), None)
+        with open(filepath + '.gz', 'w') as fo: fo.write('not gzip')
+        self.assertFalse(self.dns.loadsnapshot(filepath + '.gz'))
@@ -0,0 +1,89 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+@remark: dnsproxy压力测试，用法：python dnsload.py -w 2 -c 2 -t 10
+'''
+import os, sys, time, errno, socket, select, signal, getopt, subprocess
+from os import path
+
+BASEDIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+def stub(sock):
+    ''' answer every query with 1.2.3.4 at once. '''
+    ans = '\xc0\x0c\x00\x01\x00\x01\x00\x00\x00\x3c\x00\x04\x01\x02\x03\x04'
+    while True:
+        d, addr = sock.recvfrom(1024)
+        sock.sendto(d[:2] + '\x81\x80' + d[4:6] + '\x00\x01\x00\x00\x00\x00' + d[12:] + ans, addr)
+
+def query(id):
+    return '%s\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03www\x07example\x03com\x00\x00\x01\x00\x01' % (
+        chr(id >> 8) + chr(id & 0xff))
+
+def client(port, seconds, window, fo):
+    ''' keep window queries in flight, write the count of answers to fo. '''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect(('127.0.0.1', port))
+    sock.settimeout(1)
+    count, id, deadline = 0, 0, time.time() + seconds
+    for i in xrange(window):
+        id = (id + 1) & 0xffff
+        sock.send(query(id))
+    while time.time() < deadline:
+        try: sock.recv(1024)
+        except socket.timeout: pass # lost, refill the window
+        else: count += 1
+        id = (id + 1) & 0xffff
+        sock.send(query(id))
+    fo.write('%d\n' % count)
+
+def fork(func, *args):
+    pid = os.fork()
+    if pid == 0:
+        try: func(*args)
+        finally: os._exit(0)
+    return pid
+
+def main():
+    '''
+    -h: help
+    -w: dnsproxy workers, 1 by default
+    -c: client processes, 1 by default
+    -n: queries in flight of each client, 64 by default
+    -t: seconds, 10 by default
+    -p: port of dnsproxy, 15353 by default
+    '''
+    optlist, args = getopt.getopt(sys.argv[1:], 'hw:c:n:t:p:')
+    optdict = dict(optlist)
+    if '-h' in optdict:
+        print main.__doc__
+        return
+    workers, clients = int(optdict.get('-w', 1)), int(optdict.get('-c', 1))
+    window, seconds = int(optdict.get('-n', 64)), int(optdict.get('-t', 10))
+    port = int(optdict.get('-p', 15353))
+
+    upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    upstream.bind(('127.0.0.1', 0))
+    pids = [fork(stub, upstream)]
+    proxy = subprocess.Popen(
+        [sys.executable, 'dnsproxy.py', '-p', str(port), '-w', str(workers),
+         '-s', '127.0.0.1:%d' % upstream.getsockname()[1]], cwd=BASEDIR)
+    try:
+        time.sleep(1)
+        rfd, wfd = os.pipe()
+        fo = os.fdopen(wfd, 'w', 0)
+        t = time.time()
+        cpids = [fork(client, port, seconds, window, fo) for i in xrange(clients)]
+        for pid in cpids: os.waitpid(pid, 0)
+        t = time.time() - t
+        fo.close()
+        with os.fdopen(rfd) as fi: count = sum(int(line) for line in fi)
+        print 'dnsproxy %d workers, %d clients: %d answers in %0.1fs, %0.0f qps, %0.0f qps per worker' % (
+            workers, clients, count, t, count / t, count / t / workers)
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        for pid in pids: os.kill(pid, signal.SIGTERM)
+
+if __name__ == '__main__': main()
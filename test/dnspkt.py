@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, unittest
+
+sys.path.append("../uniproxy")
+from mydns import *
+
+class PackTest(unittest.TestCase):
+    def setUp(self):
+        self.r = Record(1234, 1, OPCODE.QUERY, 0, 0, 1, 1, 0)
+        self.r.quiz = [('www.example.com', TYPE.A, CLASS.IN)]
+        self.r.ans = [
+            ('www.example.com', TYPE.CNAME, CLASS.IN, 300, 'cdn.example.com'),
+            ('cdn.example.com', TYPE.A, CLASS.IN, 60, '1.2.3.4'),
+            ('cdn.example.com', TYPE.A, CLASS.IN, 60, '5.6.7.8')]
+        self.r.auth = [('example.com', TYPE.MX, CLASS.IN, 60, 10, 'mail.example.com')]
+
+    def test_roundtrip(self):
+        r = Record.unpack(self.r.pack())
+        self.assertEqual(r.id, 1234)
+        self.assertEqual((r.qr, r.rd, r.ra), (1, 1, 1))
+        self.assertEqual(r.quiz, self.r.quiz)
+        self.assertEqual(r.ans, self.r.ans)
+        self.assertEqual(r.auth, self.r.auth)
+
+    def test_compress(self):
+        d = self.r.pack()
+        self.assertEqual(d.count('example'), 1)
+        self.assertEqual(d[33:35], '\xc0\x0c')
+
+    def test_query(self):
+        q = mkquery(('example.com', TYPE.A))
+        self.assertEqual(Record.unpack(q.pack()).quiz, [('example.com', TYPE.A, CLASS.IN)])
+
+    def test_types(self):
+        self.r.ans.append(('www.example.com', TYPE.AAAA, CLASS.IN, 60, '2001:db8::1'))
+        self.r.ex = [('example.com', TYPE.TXT, CLASS.IN, 60, '\x05hello'),
+                     ('example.com', TYPE.NS, CLASS.IN, 60, 'ns.example.com')]
+        r = Record.unpack(self.r.pack())
+        self.assertEqual(r.ans, self.r.ans)
+        self.assertEqual(r.ex, self.r.ex)
+        self.assertEqual(len(list(r.show())), 12)
+
+    def test_level(self):
+        d = self.r.pack()
+        r = Record.unpack(d, PARSE.HEADER)
+        self.assertEqual((r.id, r.qr, r.quiz), (1234, 1, []))
+        r = Record.unpack(d, PARSE.ANSWER)
+        self.assertEqual((r.ans, r.auth), (self.r.ans, []))
+
+    def test_loop(self):
+        d = self.r.pack()
+        d = d[:12] + '\xc0\x0c' + d[14:]
+        self.assertRaises(Exception, Record.unpack, d)
+        self.assertRaises(Exception, Record.unpack, self.r.pack()[:-4])
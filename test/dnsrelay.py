@@ -0,0 +1,84 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, struct, unittest
+
+sys.path.append("../uniproxy")
+sys.path.append("..")
+import dnsproxy
+from mydns import *
+from tcpdns import reply
+# mydns brings gevent's socket in, dnsproxy works on the plain one.
+import socket, select
+
+def ready(sock):
+    if not select.select([sock], [], [], 1)[0]: raise Exception('timeout')
+
+class DNSProxyTest(unittest.TestCase):
+    def setUp(self):
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.upstream.bind(('127.0.0.1', 0))
+        self.upstream.settimeout(1)
+        self.proxy = dnsproxy.DNSProxy(0, self.upstream.getsockname())
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(1)
+        self.addr = ('127.0.0.1', self.proxy.sock.getsockname()[1])
+
+    def tearDown(self):
+        for sock in (self.upstream, self.proxy.sock, self.proxy.client, self.client):
+            sock.close()
+
+    def query(self, name):
+        ''' send a query of name from client, return it and as upstream got. '''
+        q = mkquery((name, TYPE.A)).pack()
+        self.client.sendto(q, self.addr)
+        ready(self.proxy.sock)
+        self.proxy.on_query()
+        d, addr = self.upstream.recvfrom(1024)
+        return q, d, addr
+
+    def answer(self, d, addr, **kw):
+        self.upstream.sendto(reply(d, **kw), addr)
+        ready(self.proxy.client)
+        self.proxy.on_answer()
+
+    def test_remap(self):
+        q, d, addr = self.query('example.com')
+        id = struct.unpack_from('>H', d)[0]
+        self.assertEqual(self.proxy.inquery[id][1], q[:2])
+        self.assertEqual(d[2:], q[2:])
+        self.answer(d, addr)
+        r = Record.unpack(self.client.recv(1024))
+        self.assertEqual((r.id, r.ans[0][4]), (struct.unpack_from('>H', q)[0], '1.2.3.4'))
+        self.assertEqual(len(self.proxy.inquery), 0)
+
+    def test_expire(self):
+        timeout, dnsproxy.TIMEOUT = dnsproxy.TIMEOUT, 0
+        try: q, d, addr = self.query('example.com')
+        finally: dnsproxy.TIMEOUT = timeout
+        self.proxy.expire()
+        self.assertEqual((len(self.proxy.inquery), self.proxy.stats['timeout']), (0, 1))
+        self.answer(d, addr)
+        self.client.settimeout(0.1)
+        self.assertRaises(socket.timeout, self.client.recv, 1024)
+
+    def test_fakeset(self):
+        q, d, addr = self.query('example.com')
+        self.answer(d, addr, ip='8.7.198.45')
+        self.assertEqual(len(self.proxy.inquery), 1)
+        self.answer(d, addr)
+        self.assertEqual(Record.unpack(self.client.recv(1024)).ans[0][4], '1.2.3.4')
+
+    def test_negative(self):
+        q, d, addr = self.query('none.example.com')
+        self.answer(d, addr, rcode=RCODE.NXDOMAIN)
+        self.assertEqual(Record.unpack(self.client.recv(1024)).rcode, RCODE.NXDOMAIN)
+        self.client.sendto('\x12\x34' + q[2:], self.addr)
+        ready(self.proxy.sock)
+        self.proxy.on_query()
+        r = Record.unpack(self.client.recv(1024))
+        self.assertEqual((r.id, r.rcode), (0x1234, RCODE.NXDOMAIN))
+        self.assertEqual((self.proxy.stats['query'], self.proxy.stats['cached']), (1, 1))
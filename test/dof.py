@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, base64, unittest, cStringIO
+
+sys.path.append("../uniproxy")
+import dofilter
+
+DOMAINS = '''# comment
+google.com
+Twitter.COM
+t.co
+.youtube.com.
+'''
+
+class DomainFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.filter = dofilter.DomainFilter()
+        self.filter.load(cStringIO.StringIO(DOMAINS))
+
+    def test_contains(self):
+        for d in ['google.com', 'www.google.com', 'a.b.twitter.com', 'T.CO',
+                  'www.youtube.com.', 'youtube.com']:
+            self.assertTrue(d in self.filter, d)
+        for d in ['com', 'co', 'oogle.com', 'google.com.cn', 'ft.co', '']:
+            self.assertFalse(d in self.filter, d)
+        self.assertEqual(self.filter.match('mail.google.com'), 'google.com')
+
+    def test_remove(self):
+        self.assertTrue(self.filter.remove('google.com'))
+        self.assertFalse(self.filter.remove('google.com'))
+        self.assertFalse('www.google.com' in self.filter)
+        self.assertRaises(LookupError, self.filter.remove, 'a..com')
+
+    def test_save(self):
+        s = cStringIO.StringIO()
+        self.filter.save(s)
+        self.assertEqual(s.getvalue(), 'google.com\nt.co\ntwitter.com\nyoutube.com\n')
+
+    def test_show(self):
+        self.assertEqual(list(self.filter.show()), [
+                'co', '  t', 'com', '  google', '  twitter', '  youtube'])
+
+RULES = '''[AutoProxy 0.2.9]
+! Checksum: xxx
+||google.com
+|http://85.17.73.31/
+|https://www.example.org/path
+.blogspot.com
+twitter.com/login
+/^https?:\\/\\/[^\\/]+\\.foo\\.com/
+*.wildcard.*
+||cdn.*.net
+@@||cn.google.com
+@@|http://ok.blogspot.com
+'''
+
+class RulesTest(unittest.TestCase):
+    def check(self, stream):
+        f = dofilter.DomainFilter()
+        f.loadrules(stream)
+        self.assertEqual(sorted(f.domains), [
+                '85.17.73.31', 'blogspot.com', 'google.com', 'twitter.com', 'www.example.org'])
+        self.assertEqual(sorted(f.excepts), ['cn.google.com', 'ok.blogspot.com'])
+        self.assertTrue('www.google.com' in f)
+        self.assertFalse('cn.google.com' in f)
+        self.assertFalse('a.cn.google.com' in f)
+        self.assertTrue('a.blogspot.com' in f)
+        self.assertFalse('ok.blogspot.com' in f)
+        self.assertFalse('foo.com' in f)
+
+    def test_plain(self): self.check(cStringIO.StringIO(RULES))
+
+    def test_base64(self):
+        d = base64.encodestring(RULES)
+        self.check(cStringIO.StringIO(d))
+        self.check(cStringIO.StringIO(d.replace('\n', '')))
+        self.check(cStringIO.StringIO(base64.b64encode(RULES).rstrip('=')))
@@ -4,14 +4,14 @@
 @date: 2012-10-18
 @author: shell.xu
 '''
-import sys, unittest
+import sys, time, unittest
 
 sys.path.append("../uniproxy")
 import dnsserver
 
 class LRUTest(unittest.TestCase):
     def setUp(self):
-        self.lru = dnsserver.ObjHeap(10)
+        self.lru = dnsserver.LRUCache(10)
 
     def test_lru(self):
         for i in xrange(10): self.lru[i] = i
@@ -19,3 +19,47 @@ class LRUTest(unittest.TestCase):
         for i in xrange(20, 25): self.lru[i] = i
         self.assertTrue(any(map(self.lru.get, xrange(5))))
         self.assertTrue(len(self.lru) <= 10)
+
+    def test_order(self):
+        for i in xrange(10): self.lru[i] = i
+        self.lru[3]
+        self.lru[10] = 10
+        self.assertFalse(0 in self.lru)
+        self.assertEqual(list(self.lru), [1, 2, 4, 5, 6, 7, 8, 9, 3, 10])
+        del self.lru[5]
+        self.assertEqual(len(self.lru), 9)
+        self.assertRaises(KeyError, self.lru.__delitem__, 5)
+
+    def test_ttl(self):
+        t = time.time()
+        self.lru.set(1, 'a', t - 1)
+        self.lru.set(2, 'b', t + 3600)
+        self.lru.set(3, 'c')
+        self.assertEqual(self.lru.get(1), None)
+        self.assertEqual(self.lru.get(2), 'b')
+        self.lru.set(4, 'd', t - 1)
+        self.assertEqual(self.lru.expire(), 1)
+        self.assertEqual(list(self.lru), [3, 2])
+
+    def test_expire_by_time(self):
+        self.lru.set(1, 'a', time.time() + 0.05)
+        self.lru.set(2, 'b', time.time() + 3600)
+        self.assertEqual(self.lru.get(1), 'a')
+        time.sleep(0.1)
+        self.assertEqual(self.lru.get(1), None)
+        self.assertEqual(self.lru.get(2), 'b')
+
+    def test_reset_deadline(self):
+        for i in xrange(1000): self.lru.set(i % 3, i, time.time() + 0.05)
+        self.lru.set(0, 'new', time.time() + 3600)
+        time.sleep(0.1)
+        # the old deadlines of key 0 must not purge it.
+        self.assertEqual(self.lru.expire(), 2)
+        self.assertEqual(self.lru.get(0), 'new')
+
+    def test_evict_order(self):
+        for i in xrange(10): self.lru.set(i, i, time.time() + 3600 - i)
+        self.lru.get(0)
+        self.lru.set(10, 10)
+        self.lru.set(11, 11)
+        self.assertEqual(list(self.lru), [3, 4, 5, 6, 7, 8, 9, 0, 10, 11])
@@ -45,6 +45,16 @@ def main():
     suite.addTests(loader.loadTestsFromModule(__import__('main')))
     suite.addTests(loader.loadTestsFromModule(__import__('mgr')))
     suite.addTests(loader.loadTestsFromModule(__import__('lru')))
+    suite.addTests(loader.loadTestsFromModule(__import__('nf')))
+    suite.addTests(loader.loadTestsFromModule(__import__('dof')))
+    suite.addTests(loader.loadTestsFromModule(__import__('pending')))
+    suite.addTests(loader.loadTestsFromModule(__import__('dnspkt')))
+    suite.addTests(loader.loadTestsFromModule(__import__('tcpdns')))
+    suite.addTests(loader.loadTestsFromModule(__import__('connpool')))
+    suite.addTests(loader.loadTestsFromModule(__import__('route')))
+    suite.addTests(loader.loadTestsFromModule(__import__('dnscache')))
+    suite.addTests(loader.loadTestsFromModule(__import__('dnsrelay')))
+    suite.addTests(loader.loadTestsFromModule(__import__('tcprelay')))
     unittest.TextTestRunner(verbosity = 2).run(suite)
 
 if __name__ == '__main__': main()
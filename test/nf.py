@@ -0,0 +1,183 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import os, sys, time, random, shutil, tempfile, unittest, cStringIO
+
+sys.path.append("../uniproxy")
+import netfilter
+
+ROUTES = '''10.0.0.0/8
+172.16.0.0 255.240.0.0
+192.168.0.0/16
+192.168.1.0/24
+1.0.0.0/24
+1.0.1.0/24
+'''
+
+class NetFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.nf = netfilter.NetFilter()
+        self.nf.load(cStringIO.StringIO(ROUTES))
+
+    def test_contains(self):
+        for ip in ['10.0.0.0', '10.255.255.255', '172.31.1.1', '192.168.1.1', '1.0.1.255']:
+            self.assertTrue(ip in self.nf, ip)
+        for ip in ['9.255.255.255', '11.0.0.0', '172.32.0.0', '1.0.2.0', '0.0.0.0']:
+            self.assertFalse(ip in self.nf, ip)
+
+    def test_merge(self):
+        self.assertEqual(len(self.nf.starts), 4)
+
+    def test_loadline(self):
+        self.nf.loadline('255.255.255.0/24')
+        self.assertTrue('255.255.255.255' in self.nf)
+
+    def test_save(self):
+        s = cStringIO.StringIO()
+        self.nf.save(s)
+        self.assertEqual(s.getvalue().splitlines()[0], '1.0.0.0 255.255.255.0')
+        nf = netfilter.NetFilter()
+        nf.load(cStringIO.StringIO(s.getvalue()))
+        self.assertEqual(list(nf.starts), list(self.nf.starts))
+        self.assertEqual(list(nf.ends), list(self.nf.ends))
+
+class CompileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src = os.path.join(self.tmpdir, 'routes.list')
+        self.bin = os.path.join(self.tmpdir, 'routes.bin')
+        with open(self.src, 'w') as fo: fo.write(ROUTES)
+
+    def tearDown(self): shutil.rmtree(self.tmpdir)
+
+    def test_compile(self):
+        nf = netfilter.NetFilter(self.src)
+        self.assertTrue(nf.compile(self.bin))
+        nfb = netfilter.NetFilter()
+        self.assertTrue(nfb.loadbinary(self.bin))
+        self.assertEqual(list(nfb.starts), list(nf.starts))
+        self.assertEqual(list(nfb.ends), list(nf.ends))
+        self.assertTrue('192.168.1.1' in nfb)
+        self.assertFalse('172.32.0.0' in nfb)
+
+    def test_save_binary(self):
+        netfilter.NetFilter(self.src).compile(self.bin)
+        nfb = netfilter.NetFilter()
+        nfb.loadbinary(self.bin)
+        s = cStringIO.StringIO()
+        nfb.save(s)
+        self.assertEqual(s.getvalue().splitlines(), [
+                '1.0.0.0 255.255.254.0', '10.0.0.0 255.0.0.0',
+                '172.16.0.0 255.240.0.0', '192.168.0.0 255.255.0.0'])
+
+    def test_cache(self):
+        nf = netfilter.NetFilter(self.src, cache=self.bin)
+        self.assertTrue(os.path.exists(self.bin))
+        self.assertTrue(nf.nets)
+        nf = netfilter.NetFilter(self.src, cache=self.bin)
+        self.assertFalse(nf.nets)
+        self.assertTrue('10.1.2.3' in nf)
+        # an upgraded source keeps its old mtime.
+        st = os.stat(self.src)
+        with open(self.src, 'a') as fo: fo.write('11.0.0.0/8\n')
+        os.utime(self.src, (st.st_atime, st.st_mtime))
+        nf = netfilter.NetFilter(self.src, cache=self.bin)
+        self.assertTrue(nf.nets)
+        self.assertTrue('11.1.2.3' in nf)
+        nf = netfilter.NetFilter(self.src, cache=self.bin)
+        self.assertFalse(nf.nets)
+        self.assertTrue('11.1.2.3' in nf)
+
+    def test_range2cidr(self):
+        self.assertEqual(list(netfilter.range2cidr(0, 0xffffffff)), [(0, 0x100000000)])
+        self.assertEqual(list(netfilter.range2cidr(1, 6)), [(1, 1), (2, 2), (4, 2), (6, 1)])
+
+class IPv6Test(unittest.TestCase):
+    def setUp(self):
+        self.nf = netfilter.NetFilter()
+        self.nf.load(cStringIO.StringIO(ROUTES + '''2001:db8::/32
+2001:db8:1::/48
+240e::/20
+2400:da00::/32
+fe80::/10
+::1/128
+'''))
+
+    def test_contains(self):
+        for ip in ['2001:db8::1', '2001:db8:ffff::', '240e:fff::1', 'fe80::1', '::1',
+                   '2400:da00:1::']:
+            self.assertTrue(ip in self.nf, ip)
+        for ip in ['2001:db9::1', '240e:1000::', '::2', '2400:da01::', 'fec0::1']:
+            self.assertFalse(ip in self.nf, ip)
+        self.assertTrue('10.0.0.1' in self.nf)
+
+    def test_short(self):
+        nf = netfilter.NetFilter()
+        nf.load(cStringIO.StringIO('1::/16\n'))
+        self.assertTrue('1::1' in nf)
+        self.assertFalse('::12' in nf)
+        self.assertEqual(list(nf.contains_many(['1::1', '::12'])), [True, False])
+        self.assertTrue('\x0a:\x00\x01' in self.nf)
+
+    def test_random(self):
+        prefixes = set()
+        for i in xrange(2000):
+            plen = random.randint(8, 64)
+            key = random.getrandbits(plen) << (128 - plen)
+            prefixes.add((key, plen))
+        trie = netfilter.PrefixTrie()
+        for key, plen in prefixes: trie.insert(key, plen)
+        bulk = netfilter.PrefixTrie()
+        bulk.build(prefixes)
+        for i in xrange(2000):
+            key = random.getrandbits(128)
+            if i % 2: key = random.choice(list(prefixes))[0] | random.getrandbits(64)
+            r = any(netfilter.commonlen(key, k, l) == l for k, l in prefixes)
+            self.assertEqual(key in trie, r)
+            self.assertEqual(key in bulk, r)
+
+    def test_save(self):
+        s = cStringIO.StringIO()
+        self.nf.save(s)
+        lines = s.getvalue().splitlines()
+        self.assertTrue('2001:db8::/32' in lines)
+        self.assertTrue('::1/128' in lines)
+
+    def test_compile(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            binpath = os.path.join(tmpdir, 'routes.bin')
+            self.nf.compile(binpath)
+            nf = netfilter.NetFilter()
+            nf.loadbinary(binpath)
+            self.assertTrue('2001:db8:2::' in nf)
+            self.assertFalse('2001:db9::' in nf)
+            self.assertEqual(sorted(nf.trie6), sorted(self.nf.trie6))
+        finally: shutil.rmtree(tmpdir)
+
+class ContainsManyTest(unittest.TestCase):
+    def setUp(self):
+        self.nf = netfilter.NetFilter()
+        self.nf.load(cStringIO.StringIO(ROUTES + '2001:db8::/32\n'))
+        self.ips = ['10.0.0.1', '11.0.0.1', '192.168.255.255', '2001:db8::1',
+                    '2001:db9::1', '\x01\x00\x01\x01', 0xac100001, 0]
+
+    def check(self):
+        r = self.nf.contains_many(self.ips)
+        self.assertEqual(list(r), [ip in self.nf if not isinstance(ip, (int, long))
+                                   else self.nf.ipint_in(ip) for ip in self.ips])
+        self.assertEqual(list(r), [True, False, True, True, False, True, True, False])
+
+    def test_numpy(self):
+        if netfilter.numpy is None: self.skipTest('numpy not installed')
+        self.check()
+        ips = netfilter.numpy.array([0x0a000001, 0x0b000001, 0xffffffff], netfilter.numpy.uint32)
+        self.assertEqual(list(self.nf.contains_many(ips)), [True, False, False])
+
+    def test_fallback(self):
+        numpy, netfilter.numpy = netfilter.numpy, None
+        try: self.check()
+        finally: netfilter.numpy = numpy
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, unittest
+
+sys.path.append("../uniproxy")
+import dnsserver
+
+class PendingTableTest(unittest.TestCase):
+    def setUp(self):
+        self.stats = {}
+        self.pt = dnsserver.PendingTable(self.stats, maxsize=4, slots=8)
+
+    def test_remap(self):
+        self.assertEqual(self.pt.add('a', 3, 100), 100)
+        id = self.pt.add('b', 3, 100)
+        self.assertNotEqual(id, 100)
+        self.assertEqual(self.stats['collision'], 1)
+        self.assertEqual(self.pt.get(100), 'a')
+        self.assertEqual(self.pt.pop(id), 'b')
+        self.assertEqual(self.pt.pop(id), None)
+        self.assertEqual(len(self.pt), 1)
+
+    def test_timeout(self):
+        self.pt.add('a', 1, 1)
+        self.pt.add('b', 3, 2)
+        self.pt.add('c', 6, 3)
+        self.assertEqual(self.pt.tick(), set())
+        self.assertEqual(self.pt.tick(), set([1]))
+        self.assertEqual(self.pt.tick(), set())
+        self.assertEqual(self.pt.tick(), set([2]))
+        for i in xrange(2): self.pt.tick()
+        self.assertEqual(self.pt.tick(), set([3]))
+        self.assertEqual(self.stats['timeout'], 3)
+        self.assertEqual(len(self.pt), 0)
+        self.assertRaises(Exception, self.pt.add, 'd', 7)
+
+    def test_overflow(self):
+        for i in xrange(4): self.assertTrue(self.pt.add(i, 3) is not None)
+        self.assertEqual(self.pt.add(4, 3), None)
+        self.assertEqual(self.stats['overflow'], 1)
+
+    def test_reused(self):
+        dns = dnsserver.DNSServer([('127.0.0.1', 53)], timeout=1)
+        try:
+            with dns.with_queue() as (id, qp):
+                while id in dns.inquery: dns.inquery.tick()
+                dns.inquery.add('other', 1, id)
+            self.assertEqual(dns.inquery.get(id), 'other')
+        finally: dns.stop()
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, time, unittest, cStringIO
+
+sys.path.append("../uniproxy")
+import serve, dnsserver, netfilter
+
+class RouteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.ps = serve.ProxyServer.__new__(serve.ProxyServer)
+        self.ps.dns = dnsserver.DNSServer([('127.0.0.1', 53)], timeout=1)
+        self.ps.dofilter, self.ps.blacknf = None, None
+        self.ps.whitenf = netfilter.NetFilter()
+        self.ps.whitenf.load(cStringIO.StringIO('8.0.0.0/8\n'))
+        self.ps.routes = serve.RouteCache(2)
+
+    def tearDown(self): self.ps.dns.stop()
+
+    def test_hit(self):
+        self.ps.dns.setcache('a.com', ['8.8.8.8'], 60, keep=60)
+        self.ps.dns.setcache('b.com', ['1.1.1.1'], 60, keep=60)
+        self.assertTrue(self.ps.usesocks('a.com'))
+        self.assertFalse(self.ps.usesocks('b.com'))
+        self.assertTrue(self.ps.usesocks('a.com'))
+        self.assertEqual((self.ps.routes.hit, self.ps.routes.miss), (1, 2))
+
+    def test_ttl(self):
+        self.ps.dns.setcache('a.com', ['8.8.8.8'], 0.05, keep=60)
+        self.assertTrue(self.ps.usesocks('a.com'))
+        self.assertTrue(self.ps.routes.get('a.com'))
+        time.sleep(0.1)
+        # the address is kept in dns cache, but the route expired with its ttl.
+        self.assertEqual(self.ps.routes.get('a.com'), None)
+        self.assertTrue(self.ps.usesocks('a.com'))
+        self.assertEqual(self.ps.routes.get('a.com'), None)
+
+    def test_evict(self):
+        for name in ['a.com', 'b.com', 'c.com']:
+            self.ps.dns.setcache(name, ['8.8.8.8'], 60)
+            self.ps.usesocks(name)
+        self.assertEqual(self.ps.routes.get('a.com'), None)
+        self.assertTrue(self.ps.routes.get('c.com'))
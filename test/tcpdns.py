@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, time, random, struct, unittest, gevent
+from contextlib import contextmanager
+from gevent import socket, server
+
+sys.path.append("../uniproxy")
+import dnsserver, dofilter
+from mydns import *
+
+class PlainManager(object):
+    def __init__(self): self.count = 0
+
+    @contextmanager
+    def socket(self):
+        self.count += 1
+        sock = socket.socket()
+        try: yield sock
+        finally: sock.close()
+
+def reply(d, ip='1.2.3.4', rcode=RCODE.NOERROR, ttl=60):
+    ''' answer query d with ip, or 2001:db8::1 for AAAA, nothing if rcode. '''
+    q = Record.unpack(d)
+    r = Record(q.id, 1, q.opcode, 0, 0, q.rd, 1, rcode)
+    name, type, cls = q.quiz[0]
+    r.quiz, r.ans = q.quiz, [] if rcode else [
+        (name, type, CLASS.IN, ttl, '2001:db8::1' if type == TYPE.AAAA else ip)]
+    return r.pack()
+
+def stub_handle(maxreq, delay=0):
+    ''' answer every query with 1.2.3.4, or 2001:db8::1 for AAAA,
+    after a random delay, so answers come
+    out of order. close the connection after maxreq queries.
+    delay: seconds to wait after accept and before each answer, at most. '''
+    def answer(sock, d):
+        gevent.sleep(random.random() * delay)
+        d = reply(d)
+        sock.sendall(struct.pack('>H', len(d)) + d)
+    def handle(sock, addr):
+        stream, grs = sock.makefile(), []
+        gevent.sleep(delay)
+        while len(grs) < maxreq:
+            d = stream.read(2)
+            if len(d) < 2: break
+            grs.append(gevent.spawn(answer, sock, stream.read(struct.unpack('>H', d)[0])))
+        gevent.joinall(grs)
+    return handle
+
+class TCPDNSTest(unittest.TestCase):
+    def start(self, maxreq=1000000):
+        self.srv = server.StreamServer(('127.0.0.1', 0), stub_handle(maxreq))
+        self.srv.start()
+        self.cm = PlainManager()
+        self.dns = dnsserver.TCPDNSServer(
+            [('127.0.0.1', self.srv.server_port)], self.cm, timeout=5, conns=2)
+
+    def tearDown(self):
+        self.dns.stop()
+        self.srv.stop()
+
+    def resolve(self, count):
+        names = ['h%d.example.com' % i for i in xrange(count)]
+        grs = [gevent.spawn(self.dns.gethostbyname, n) for n in names]
+        gevent.joinall(grs, timeout=5)
+        return [gr.value for gr in grs]
+
+    def test_pipeline(self):
+        self.start()
+        self.assertEqual(self.resolve(100), ['1.2.3.4'] * 100)
+        self.assertEqual(self.cm.count, 2)
+        self.assertEqual(self.dns.stats['upstream'], 100)
+
+    def test_reconnect(self):
+        self.start(maxreq=3)
+        self.assertEqual(self.resolve(20), ['1.2.3.4'] * 20)
+        self.assertTrue(self.cm.count > 2)
+
+    def test_getaddrs(self):
+        self.start()
+        self.dns.RESOLVE_DELAY = 1
+        self.assertEqual(self.dns.getaddrs('example.com'), ['2001:db8::1', '1.2.3.4'])
+        self.assertEqual(self.dns.getaddrs('::1'), ['::1'])
+        self.dns.setcache('v4.example.com', [], 60, TYPE.AAAA)
+        self.assertEqual(self.dns.getaddrs('v4.example.com'), ['1.2.3.4'])
+        self.assertEqual(self.dns.stats['upstream'], 3)
+
+    def test_rank(self):
+        self.start()
+        self.dns.EXPLORE = 0
+        self.dns.setcache('cdn.com', ['1.1.1.1', '2.2.2.2', '3.3.3.3'], 60)
+        self.dns.report('cdn.com', '1.1.1.1', 0.3)
+        self.dns.report('cdn.com', '2.2.2.2', 0.01)
+        self.assertEqual(self.dns.gethostbyname('cdn.com'), '3.3.3.3')
+        self.dns.report('cdn.com', '3.3.3.3')
+        self.assertEqual(self.dns.gethostbyname('cdn.com'), '2.2.2.2')
+        self.dns.setcache('cdn.com', ['1.1.1.1', '3.3.3.3'], 60)
+        r = self.dns.cache.get(('cdn.com', TYPE.A))
+        self.assertEqual(sorted(r[3]), ['1.1.1.1', '3.3.3.3'])
+        self.assertEqual(self.dns.ranked(r), ['1.1.1.1', '3.3.3.3'])
+
+    def test_split(self):
+        self.start()
+        udp = server.DatagramServer(
+            ('127.0.0.1', 0), lambda d, addr: udp.sendto(reply(d, '6.6.6.6'), addr))
+        udp.start()
+        domains = dofilter.DomainFilter()
+        domains.add('blocked.com')
+        dns = dnsserver.DNSServer([('127.0.0.1', udp.server_port)], timeout=5,
+                                  remote=[('127.0.0.1', self.srv.server_port)],
+                                  cmanager=self.cm, domains=domains)
+        try:
+            self.assertEqual(dns.gethostbyname('www.blocked.com'), '1.2.3.4')
+            self.assertEqual(dns.gethostbyname('example.com'), '6.6.6.6')
+            self.assertEqual(dns.stats['remote'], 1)
+            self.assertEqual(len(dns.cache), 2)
+        finally:
+            dns.stop()
+            udp.stop()
+
+class NegativeTest(unittest.TestCase):
+    def setUp(self):
+        self.count = 0
+        def handle(d, addr):
+            self.count += 1
+            self.udp.sendto(reply(d, rcode=RCODE.NXDOMAIN), addr)
+        self.udp = server.DatagramServer(('127.0.0.1', 0), handle)
+        self.udp.start()
+        self.silent = server.DatagramServer(('127.0.0.1', 0), lambda d, addr: None)
+        self.silent.start()
+        self.dns = dnsserver.DNSServer([('127.0.0.1', self.udp.server_port),
+                                        ('127.0.0.1', self.silent.server_port)], timeout=5)
+
+    def tearDown(self):
+        self.dns.stop()
+        self.udp.stop()
+        self.silent.stop()
+
+    def test_nxdomain(self):
+        self.assertEqual(self.dns.gethostbyname('nx.example.com'), None)
+        self.assertEqual(self.dns.gethostbyname('nx.example.com'), None)
+        self.assertEqual(self.count, 1)
+        self.assertEqual([u.loss for u in self.dns.upstreams], [0.0, 0.0])
+        r = self.dns.cache.get(('nx.example.com', TYPE.A))
+        self.assertEqual((r[1], r[4]), ([], RCODE.NXDOMAIN))
+        q = Record.unpack(self.dns.answer(mkquery(('nx.example.com', TYPE.A))))
+        self.assertEqual((q.rcode, q.ans), (RCODE.NXDOMAIN, []))
+
+class TTLTest(unittest.TestCase):
+    def test_answer(self):
+        udp = server.DatagramServer(
+            ('127.0.0.1', 0), lambda d, addr: udp.sendto(reply(d, ttl=60), addr))
+        udp.start()
+        dns = dnsserver.DNSServer([('127.0.0.1', udp.server_port)], timeout=5)
+        try:
+            self.assertEqual(dns.gethostbyname('example.com'), '1.2.3.4')
+            r = dns.cache.get(('example.com', TYPE.A))
+            self.assertTrue(r[0] - time.time() > 3000)
+            q = Record.unpack(dns.answer(mkquery(('example.com', TYPE.A))))
+            self.assertTrue(55 < q.ans[0][3] <= 60)
+            r[5] = time.time() - 1
+            self.assertEqual(dns.answer(mkquery(('example.com', TYPE.A))), None)
+        finally:
+            dns.stop()
+            udp.stop()
@@ -0,0 +1,103 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+'''
+@date: 2026-10-18
+@author: shell.xu
+'''
+import sys, struct, unittest
+
+sys.path.append("../uniproxy")
+sys.path.append("..")
+import dns2tcp
+from mydns import *
+from tcpdns import reply
+# mydns brings gevent's socket in, dns2tcp works on the plain one.
+import socket, select
+
+class DNS2TCPTest(unittest.TestCase):
+    def setUp(self):
+        self.upstream = socket.socket()
+        self.upstream.bind(('127.0.0.1', 0))
+        self.upstream.listen(8)
+        self.proxy = dns2tcp.DNS2TCP(0, self.upstream.getsockname(), 1)
+        self.client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.client.settimeout(1)
+        self.addr = ('127.0.0.1', self.proxy.sock.getsockname()[1])
+        self.conn = None
+
+    def tearDown(self):
+        for sock in (self.upstream, self.proxy.sock, self.client, self.conn):
+            if sock is not None: sock.close()
+        for up in self.proxy.conns:
+            if up.sock is not None: up.sock.close()
+
+    def pump(self, sock):
+        ''' run the proxy until sock is readable. '''
+        for i in xrange(100):
+            if select.select([sock], [], [], 0)[0]: return
+            for fd, ev in self.proxy.poll.poll(10): self.proxy.fdmap[fd](ev)
+        raise Exception('timeout')
+
+    def query(self, name, id=0x1234):
+        ''' send a query of name from client, return it and as upstream got. '''
+        q = mkquery((name, TYPE.A))
+        q.id = id
+        q = q.pack()
+        self.client.sendto(q, self.addr)
+        return q, self.recv()
+
+    def recv(self):
+        if self.conn is None:
+            self.pump(self.upstream)
+            self.conn = self.upstream.accept()[0]
+            self.conn.settimeout(1)
+        self.pump(self.conn)
+        l = struct.unpack('>H', self.conn.recv(2))[0]
+        return self.conn.recv(l)
+
+    def answer(self, d, **kw):
+        d = reply(d, **kw)
+        self.conn.sendall(struct.pack('>H', len(d)) + d)
+
+    def test_remap(self):
+        q, d = self.query('example.com')
+        id = struct.unpack_from('>H', d)[0]
+        self.assertEqual(self.proxy.inquery[id][1], q[:2])
+        self.assertEqual(d[2:], q[2:])
+        self.answer(d)
+        self.pump(self.client)
+        r = Record.unpack(self.client.recv(1024))
+        self.assertEqual((r.id, r.ans[0][4]), (0x1234, '1.2.3.4'))
+        self.assertEqual(len(self.proxy.inquery), 0)
+
+    def test_expire(self):
+        timeout, dns2tcp.TIMEOUT = dns2tcp.TIMEOUT, 0
+        try: q, d = self.query('example.com')
+        finally: dns2tcp.TIMEOUT = timeout
+        self.proxy.expire()
+        self.assertEqual(len(self.proxy.inquery), 0)
+        self.answer(d)
+        self.assertRaises(Exception, self.pump, self.client)
+
+    def test_cache(self):
+        q, d = self.query('example.com')
+        self.answer(d, ttl=60)
+        self.pump(self.client)
+        self.client.recv(1024)
+        quiz, r = self.proxy.cache.items()[0]
+        self.proxy.cache[quiz] = (r[0], r[1] - 10) + r[2:] # cached 10s ago
+        self.client.sendto('\x43\x21' + q[2:], self.addr)
+        self.pump(self.client)
+        r = Record.unpack(self.client.recv(1024))
+        self.assertEqual((r.id, r.ans[0][4]), (0x4321, '1.2.3.4'))
+        self.assertEqual(r.ans[0][3], 50)
+        self.assertFalse(select.select([self.conn], [], [], 0)[0])
+
+    def test_broken(self):
+        q, d = self.query('example.com')
+        self.conn.close()
+        self.conn = None
+        self.assertEqual(self.recv(), d)
+        self.answer(d)
+        self.pump(self.client)
+        self.assertEqual(Record.unpack(self.client.recv(1024)).id, 0x1234)
@@ -4,9 +4,11 @@
 @date: 2012-09-29
 @author: shell.xu
 '''
-import logging
+import time, logging, collections, gevent
 from contextlib import contextmanager
-from gevent import ssl, dns, coros, socket, Timeout
+from gevent import ssl, queue, select, socket, Timeout
+try: from gevent import coros
+except ImportError: from gevent import lock as coros
 from gevent import with_timeout as call_timeout
 from http import *
 
@@ -21,51 +23,303 @@ def ssl_socket(certfile=None):
         return creator
     return reciver
 
-class DirectManager(object):
+class DirectSocket(object):
+    ''' a socket which connects by racing addresses of the host,
+    and works as the winner after. '''
+
+    def __init__(self, manager): self.manager, self.sock = manager, None
+
+    def connect(self, addr): self.sock = self.manager.connect(addr)
+
+    def close(self):
+        if self.sock is not None: self.sock.close()
+
+    def __getattr__(self, name): return getattr(self.sock, name)
+
+class Overload(Exception): pass
+
+class Health(object):
+    ''' ewma of connect time, time to first byte and error rate. after FAILS
+    errors in a row, it is ejected for EJECT seconds, doubled each time up
+    to MAX_EJECT. then one request is let through to probe it, which
+    ejects it again on failure, or brings it back on success. '''
+    ALPHA     = 0.2
+    FAILS     = 3
+    EJECT     = 10
+    MAX_EJECT = 300
+
+    def __init__(self):
+        self.connrtt, self.ttfb, self.errors = 0.1, 0.5, 0.0
+        self.fails, self.eject, self.until = 0, self.EJECT, 0
+
+    def report(self, connrtt=None, ttfb=None, error=False):
+        if error:
+            self.errors += self.ALPHA * (1 - self.errors)
+            self.fails += 1
+            if self.fails >= self.FAILS:
+                logger.info('%s ejected for %ds' % (self.name, self.eject))
+                self.until = time.time() + self.eject
+                self.eject = min(self.eject * 2, self.MAX_EJECT)
+            return
+        if connrtt is not None: self.connrtt += self.ALPHA * (connrtt - self.connrtt)
+        if ttfb is not None: self.ttfb += self.ALPHA * (ttfb - self.ttfb)
+        self.errors -= self.ALPHA * self.errors
+        self.fails, self.eject, self.until = 0, self.EJECT, 0
+
+    def ejected(self): return self.until > time.time()
+
+    def picked(self):
+        ''' it is chosen, as a probe if it was ejected. '''
+        if self.fails >= self.FAILS: self.until = time.time() + self.eject
+
+    def score(self):
+        ''' expected time of a request, the lower the better. '''
+        return (self.connrtt + self.ttfb) * (1 + 10 * self.errors)
+
+    def health(self):
+        return 'conn %dms ttfb %dms err %d%%%s' % (
+            self.connrtt * 1000, self.ttfb * 1000, self.errors * 100,
+            ' ejected' if self.ejected() else '')
+
+class Pool(object):
+    ''' idle keep-alive connections, kept by address they connected to.
+    an idle one still counts as in use, it is closed after IDLE seconds,
+    or when a new connection needs the room. '''
+    IDLE     = 30 # seconds an idle connection is kept
+    MAX_IDLE = 8  # idle connections kept at most, of all addresses
+
+    def __init__(self):
+        super(Pool, self).__init__()
+        self.idle, self.nidle, self.hit, self.miss = {}, 0, 0, 0
+
+    def acquire(self, addr, fresh=False):
+        ''' return (sock, reused), an idle connection to addr if there is,
+        or a new one. release it after. '''
+        self.prune()
+        socks = self.idle.get(addr)
+        while socks and not fresh:
+            sock = self.popidle(addr, -1)
+            # readable means closed by peer, or garbage comes.
+            if not select.select([sock], [], [], 0)[0]:
+                self.hit += 1
+                return sock, True
+            self.discard(sock)
+        self.miss += 1
+        return self.new(addr), False
+
+    def release(self, addr, sock, reuse=False):
+        ''' keep sock idle if reuse, otherwise close it, and so when others
+        are waiting, as an idle one holds the room they wait for. '''
+        if not reuse or self.waiting(): return self.discard(sock)
+        if self.nidle >= self.MAX_IDLE: self.evict()
+        self.idle.setdefault(addr, []).append((time.time(), sock))
+        self.nidle += 1
+
+    def popidle(self, addr, i):
+        socks = self.idle[addr]
+        sock = socks.pop(i)[1]
+        if not socks: del self.idle[addr]
+        self.nidle -= 1
+        return sock
+
+    def discard(self, sock):
+        sock.close()
+        self.free()
+
+    def evict(self):
+        ''' close the connection idle for the longest time. '''
+        if not self.idle: return
+        addr = min(self.idle, key=lambda a: self.idle[a][0][0])
+        self.discard(self.popidle(addr, 0))
+
+    def prune(self):
+        t = time.time() - self.IDLE
+        for addr, socks in self.idle.items():
+            while addr in self.idle and socks[0][0] < t:
+                self.discard(self.popidle(addr, 0))
+
+    def waiting(self): return 0
+
+class DirectManager(Pool):
     name = 'direct'
+    DELAY  = 0.25 # start next connection attempt after, rfc 8305
+    FAILED = 60   # seconds an unreachable address is tried after others
 
-    def __init__(self, dns): self.count, self.dns = 0, dns
+    def __init__(self, dns):
+        super(DirectManager, self).__init__()
+        self.count, self.dns, self.failed = 0, dns, {}
 
     def size(self): return 65536
-    def stat(self): return '%d/unlimited' % self.count
+    def stat(self):
+        return '%d/unlimited %d idle %d failed' % (self.count, self.nidle, len(self.failed))
+
+    def new(self, addr):
+        sock = DirectSocket(self)
+        sock.connect(addr)
+        self.count += 1
+        return sock
+
+    def free(self): self.count -= 1
+
+    def getaddrs(self, host):
+        if self.dns is not None: return self.dns.getaddrs(host)
+        # no dnsserver configured, ask the system resolver.
+        try: infos = socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+        except socket.gaierror: return []
+        addrs = []
+        for info in infos:
+            if info[4][0] not in addrs: addrs.append(info[4][0])
+        return addrs
+
+    def report(self, host, a, rtt=None):
+        if self.dns is not None: self.dns.report(host, a, rtt)
+
+    def connect(self, addr):
+        addrs = self.getaddrs(addr[0])
+        if not addrs: raise Exception('DNS not found')
+        t = time.time()
+        if len(self.failed) > 1024:
+            for k, v in self.failed.items():
+                if v < t: del self.failed[k]
+        addrs.sort(key=lambda a: self.failed.get(a, 0) > t)
+        return self.race(addr[0], addrs, addr[1])
+
+    def race(self, host, addrs, port):
+        ''' start a connection to each address in turn, after DELAY or once
+        the last one failed. the first connected wins, others are closed.
+        connect time of each address is reported to dns, losers slower than
+        DELAY as failed. '''
+        q, grs, pending = queue.Queue(), [], {}
+        def attempt(a):
+            sock = socket.socket(socket.AF_INET6 if ':' in a else socket.AF_INET)
+            try: sock.connect((a, port))
+            except BaseException, err: # killed as a loser too
+                sock.close()
+                q.put((a, None, err))
+            else: q.put((a, sock, None))
+
+        go, err, started, finished = True, None, 0, 0
+        try:
+            while addrs or finished < started:
+                if addrs and go:
+                    a = addrs.pop(0)
+                    pending[a] = time.time()
+                    grs.append(gevent.spawn(attempt, a))
+                    go, started = False, started + 1
+                try: a, sock, e = q.get(timeout=self.DELAY if addrs else None)
+                except queue.Empty:
+                    go = True
+                    continue
+                finished += 1
+                t = time.time()
+                if sock is not None:
+                    self.report(host, a, t - pending.pop(a))
+                    return sock
+                logger.debug('connect %s:%d failed: %s' % (a, port, e))
+                self.report(host, a)
+                del pending[a]
+                self.failed[a] = t + self.FAILED
+                go, err = True, e
+            raise err
+        finally:
+            gevent.killall(grs)
+            t = time.time()
+            for a, st in pending.iteritems():
+                if t - st > self.DELAY: self.report(host, a)
+            while not q.empty():
+                s = q.get()[1]
+                if s is not None: s.close()
 
     @contextmanager
     def socket(self):
         self.count += 1
         logger.debug('%s %s allocated' % (self.name, self.stat()))
-        sock = socket.socket()
-        connect = sock.connect
-        def newconn(addr):
-            # 没办法，gevent的dns这时如果碰到多ip返回值，会直接报错
-            try: connect(addr)
-            except dns.DNSError:
-                address = self.dns.gethostbyname(addr[0])
-                if address is None: raise Exception('DNS not found')
-                sock.connect((address, addr[1]))
-        sock.connect = newconn
+        sock = DirectSocket(self)
         try: yield sock
         finally:
             sock.close()
             logger.debug('%s %s released' % (self.name, self.stat()))
             self.count -= 1
 
-class Manager(object):
+class Manager(Pool, Health):
+    ''' at most MAX_QUEUE requests wait for a connection when all are in
+    use, each for WAIT seconds at most. others fail with Overload. '''
+    MAX_QUEUE = 64
+    WAIT      = 10
+    CONNECT   = 30 # seconds to set up a connection through the proxy
+
     def __init__(self, max_conn=10, name=None, **kargs):
+        super(Manager, self).__init__()
         self.smph, self.max_conn = coros.BoundedSemaphore(max_conn), max_conn
         self.name, self.creator = name, socket.socket
+        self.queued, self.waits = 0, collections.deque(maxlen=1000)
 
     def size(self): return self.max_conn - self.smph.counter
-    def stat(self): return '%d/%d' % (self.size(), self.max_conn)
+    def stat(self):
+        return '%d/%d %d idle %s %s' % (
+            self.size(), self.max_conn, self.nidle, self.health(), self.queue())
+
+    def queue(self):
+        ''' queue depth, and percentiles of recent waiting time. '''
+        waits = sorted(self.waits) or [0]
+        return 'queue %d/%d wait p50 %dms p90 %dms p99 %dms' % ((
+                self.queued, self.MAX_QUEUE) + tuple(
+                waits[int(len(waits) * p)] * 1000 for p in (0.5, 0.9, 0.99)))
+
+    def waiting(self): return self.queued
+
+    def wait(self):
+        ''' take a slot, idle connections are closed to make room. no one
+        parks a connection while others wait, so none appears in blocking. '''
+        self.prune()
+        while not self.smph.acquire(blocking=False):
+            if not self.nidle: break
+            self.evict()
+        else:
+            self.waits.append(0)
+            return
+        if self.queued >= self.MAX_QUEUE:
+            raise Overload('%s queue full' % self.name)
+        t, self.queued = time.time(), self.queued + 1
+        try: ok = self.smph.acquire(timeout=self.WAIT)
+        finally: self.queued -= 1
+        self.waits.append(time.time() - t)
+        if not ok: raise Overload('%s wait timeout' % self.name)
+
+    def new(self, addr):
+        self.wait()
+        sock = None
+        try:
+            # a proxy may accept and then hang, give up after CONNECT.
+            with Timeout(self.CONNECT):
+                sock = self.creator()
+                t = time.time()
+                sock.connect(addr)
+        except BaseException, err:
+            if sock is not None: sock.close()
+            self.smph.release()
+            if self.failed(err): self.report(error=True)
+            raise
+        self.report(connrtt=time.time() - t)
+        return sock
+
+    def free(self): self.smph.release()
+
+    def failed(self, err):
+        ''' err is a failure of the proxy, not of the target behind it. '''
+        return isinstance(err, (EOFError, socket.error, Timeout))
 
     @contextmanager
     def socket(self):
-        with self.smph:
+        self.wait()
+        try:
             logger.debug('%s %s allocated' % (self.name, self.stat()))
             sock = self.creator()
             try: yield sock
             finally:
                 sock.close()
                 logger.debug('%s %s released' % (self.name, self.stat()))
+        finally: self.smph.release()
 
 def http_connect(sock, target, username=None, password=None):
     stream = sock.makefile()
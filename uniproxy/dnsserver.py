@@ -4,100 +4,339 @@
 @date: 2012-09-29
 @author: shell.xu
 '''
-import sys, time, heapq, random, getopt, logging, cStringIO, gevent
+import os, sys, time, math, heapq, random, struct, getopt, logging, gevent
+from os import path
 from mydns import *
 from contextlib import contextmanager
-from gevent import socket, queue
+from gevent import pool, event, socket, queue
 
 logger = logging.getLogger('dnsserver')
 
-class ObjHeap(object):
-    ''' 使用lru算法的对象缓存容器，感谢Evan Prodromou <evan@bad.dynu.ca>。
-    thx for Evan Prodromou <evan@bad.dynu.ca>. '''
-    MAXSEQ = 0x100000000
-
-    class __node(object):
-        def __init__(self, k, v, f): self.k, self.v, self.f = k, v, f
-        def __cmp__(self, o): return self.f > o.f
+class LRUCache(object):
+    ''' lru cache with O(1) get, set and delete.
+    an entry can carry a deadline, it is purged by expire() once passed. '''
 
     def __init__(self, size):
         self.size = size
         self.clean()
 
     def clean(self):
-        self.f, self.__dict, self.__heap = 0, {}, []
+        # node: [prev, next, key, value, deadline], root.next is the oldest.
+        self.root = [None, None, None, None, None]
+        self.root[0] = self.root[1] = self.root
+        self.__dict, self.__deadlines = {}, []
+
+    def __unlink(self, n): n[0][1], n[1][0] = n[1], n[0]
+
+    def __append(self, n):
+        last = self.root[0]
+        n[0], n[1] = last, self.root
+        last[1] = self.root[0] = n
 
-    def getseq(self):
-        if self.f >= self.MAXSEQ:
-            self.f = 1
-            for n in self.__heap: n.f = 0
-        else: self.f += 1
-        return self.f
+    def __remove(self, n):
+        self.__unlink(n)
+        del self.__dict[n[2]]
 
     def __len__(self): return len(self.__dict)
-    def __contains__(self, k): return self.__dict.has_key(k)
-
-    def __setitem__(self, k, v):
-        if self.__dict.has_key(k):
-            n = self.__dict[k]
-            n.v, n.f = v, self.getseq()
-        elif len(self.__heap) < self.size:
-            n = self.__node(k, v, self.getseq())
-            self.__heap.append(n)
-            self.__dict[k] = n
+    def __contains__(self, k): return self.getnode(k) is not None
+
+    def getnode(self, k):
+        n = self.__dict.get(k)
+        if n is None: return None
+        if n[4] is not None and n[4] <= time.time():
+            self.__remove(n)
+            return None
+        return n
+
+    def set(self, k, v, deadline=None):
+        n = self.__dict.get(k)
+        if n is not None:
+            self.__unlink(n)
+            n[3], n[4] = v, deadline
         else:
-            heapq.heapify(self.__heap)
-            try:
-                while len(self.__heap) > self.size:
-                    del self.__dict[heapq.heappop(self.__heap).k]
-                n = self.__node(k, v, self.getseq())
-                del self.__dict[heapq.heappushpop(self.__heap, n).k]
-                self.__dict[k] = n
-            except KeyError: self.clean()
+            self.expire()
+            if len(self.__dict) >= self.size: self.__remove(self.root[1])
+            n = [None, None, k, v, deadline]
+            self.__dict[k] = n
+        self.__append(n)
+        if deadline is not None:
+            heapq.heappush(self.__deadlines, (deadline, k))
+            if len(self.__deadlines) > 2 * self.size + 16:
+                self.__deadlines = [(n[4], k) for k, n in self.__dict.iteritems()
+                                    if n[4] is not None]
+                heapq.heapify(self.__deadlines)
+
+    def __setitem__(self, k, v): self.set(k, v)
 
     def __getitem__(self, k):
-        n = self.__dict[k]
-        n.f = self.getseq()
-        return n.v
+        n = self.getnode(k)
+        if n is None: raise KeyError(k)
+        self.__unlink(n)
+        self.__append(n)
+        return n[3]
 
-    def get(self, k):
-        n = self.__dict.get(k)
-        if n is None: return None
-        n.f = self.getseq()
-        return n.v
+    def get(self, k, default=None):
+        try: return self[k]
+        except KeyError: return default
 
     def __delitem__(self, k):
         n = self.__dict[k]
-        self.__heap.remove(n)
-        del self.__dict[k]
-        return n.v
+        self.__remove(n)
+        return n[3]
+
+    def expire(self):
+        ''' purge all entries which deadline passed, return the count. '''
+        t, count, deadlines = time.time(), 0, self.__deadlines
+        while deadlines and deadlines[0][0] <= t:
+            deadline, k = heapq.heappop(deadlines)
+            n = self.__dict.get(k)
+            if n is not None and n[4] == deadline:
+                self.__remove(n)
+                count += 1
+        return count
+
+    def __iter__(self): return iter([k for k, v, deadline in self.items()])
+
+    def items(self):
+        ''' return (key, value, deadline) from the oldest to the newest. '''
+        n, r = self.root[1], []
+        while n is not self.root:
+            r.append((n[2], n[3], n[4]))
+            n = n[1]
+        return r
+
+class PendingTable(object):
+    ''' pending dns queries by upstream id, expired by a timer wheel.
+    ids are allocated here, so the same client id from different clients
+    never collide upstream. a timeout must be shorter than slots - 1 ticks. '''
+    TICK = 1
+
+    def __init__(self, stats, maxsize=4096, slots=64):
+        self.stats, self.maxsize, self.table = stats, maxsize, {}
+        self.wheel, self.cur = [set() for i in xrange(slots)], 0
+        for k in ['timeout', 'collision', 'overflow']: self.stats.setdefault(k, 0)
+
+    def __len__(self): return len(self.table)
+    def __contains__(self, id): return id in self.table
+
+    def add(self, callback, timeout, id=None):
+        ''' register callback, keep id if it is free.
+        return the id in use, or None if table is full. '''
+        if len(self.table) >= self.maxsize:
+            self.stats['overflow'] += 1
+            return None
+        if id is None or id in self.table:
+            if id is not None: self.stats['collision'] += 1
+            id = random.randint(0, 0xffff)
+            while id in self.table: id = random.randint(0, 0xffff)
+        # one more tick, as the current one has partly passed.
+        ticks = max(int(math.ceil(timeout / self.TICK)), 1) + 1
+        if ticks >= len(self.wheel):
+            raise Exception('timeout %s is too long for pending table' % timeout)
+        slot = (self.cur + ticks) % len(self.wheel)
+        self.table[id] = (callback, slot)
+        self.wheel[slot].add(id)
+        return id
+
+    def get(self, id):
+        r = self.table.get(id)
+        if r is not None: return r[0]
+
+    def pop(self, id):
+        r = self.table.pop(id, None)
+        if r is None: return None
+        self.wheel[r[1]].discard(id)
+        return r[0]
+
+    def tick(self):
+        ''' advance the wheel one slot, drop all queries in it. '''
+        self.cur = (self.cur + 1) % len(self.wheel)
+        ids, self.wheel[self.cur] = self.wheel[self.cur], set()
+        for id in ids: del self.table[id]
+        self.stats['timeout'] += len(ids)
+        return ids
 
-    def __iter__(self):
-        c = self.__heap[:]
-        while len(c): yield heapq.heappop(c).k
+class Scoreboard(object):
+    ''' ewma of rtt and loss. '''
+    ALPHA = 0.2
+
+    def __init__(self): self.srtt, self.loss = 0.1, 0.0
+
+    def answered(self, rtt=None):
+        if rtt is not None: self.srtt += self.ALPHA * (rtt - self.srtt)
+        self.loss -= self.ALPHA * self.loss
+
+    def lost(self): self.loss += self.ALPHA * (1 - self.loss)
+
+    def score(self): return self.srtt * (1 + 10 * self.loss)
+
+class Upstream(Scoreboard):
+    ''' scoreboard of one upstream dns server. '''
+
+    def __init__(self, addr):
+        super(Upstream, self).__init__()
+        self.addr = addr
+
+    def rto(self): return min(max(2 * self.srtt, 0.1), 2.0)
+
+    def stat(self):
+        return '%s:%d rtt %dms loss %d%%' % (
+            self.addr[0], self.addr[1], self.srtt * 1000, self.loss * 100)
 
 class DNSServer(object):
     DNSSERVER = '8.8.8.8'
     DNSPORT   = 53
     TIMEOUT   = 3600
-    RETRY     = 3
-
-    def __init__(self, dnsserver, cachesize=512, timeout=30):
-        self.dnsserver = dnsserver or self.DNSSERVER
-        self.cache, self.cachesize = ObjHeap(cachesize), cachesize
-        self.timeout = timeout
+    SWEEP     = 60
+    SNAPSHOT  = 600
+    HOTHITS   = 3
+    REFRESH   = 30
+    GRACE     = 30
+    NEGATIVE  = 300
+    KEEP      = 60 # answers are cached KEEP times their ttl
+    RESOLVE_DELAY = 0.05
+    EXPLORE   = 0.05
+
+    def __init__(self, dnsserver, cachesize=512, timeout=30, snapshot=None, stale=0,
+                 refreshes=8, remote=None, cmanager=None, domains=None, conns=2):
+        ''' dnsserver: an upstream server, or a list of them, which are raced.
+        an upstream is an ip or (ip, port).
+        snapshot: file to keep the cache across restarts.
+        stale: seconds an expired record can still be served if query failed.
+        refreshes: max background refreshes at the same time.
+        remote: upstreams queried in tcp through cmanager, for names in domains,
+        a DomainFilter. conns: tcp connections to each of them. '''
+        self.upstreams = self.mkupstreams(dnsserver or self.DNSSERVER)
+        self.remotes = self.mkupstreams(remote) if remote else []
+        self.domains, self.clients = domains, {}
+        self.cache, self.cachesize = LRUCache(cachesize), cachesize
+        self.timeout, self.snapshot, self.stale = timeout, snapshot, stale
+        if self.snapshot: self.loadsnapshot(self.snapshot)
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.fakeset = set()
-        self.inquery = {}
+        self.refresher = pool.Pool(refreshes)
+        self.stats = {'upstream': 0, 'coalesced': 0, 'refresh': 0, 'grace': 0, 'local': 0,
+                      'remote': 0}
+        slots = max(64, int(math.ceil(timeout / PendingTable.TICK)) + 2)
+        self.inquery, self.inflight = PendingTable(self.stats, slots=slots), {}
+        if self.remotes: self.tcpclients(self.remotes, cmanager, conns)
         self.gr = gevent.spawn(self.receiver)
+        self.sweeper = gevent.spawn(self.sweep)
+        self.ticker = gevent.spawn(self.tick)
         self.srv = None
 
+    def mkupstreams(self, addrs):
+        if not isinstance(addrs, list): addrs = [addrs,]
+        return [Upstream(addr if isinstance(addr, tuple) else (addr, self.DNSPORT))
+                for addr in addrs]
+
+    def tcpclients(self, upstreams, cmanager, conns):
+        ''' query upstreams in tcp through cmanager, direct if None. '''
+        if cmanager is None:
+            import conn
+            cmanager = conn.DirectManager(self)
+        for u in upstreams:
+            self.clients[u] = TCPDNSClient(u.addr, cmanager, self.on_answer, conns, self.timeout)
+
     def runserver(self, dnsport=None):
         self.srv = gevent.spawn(self.server, dnsport)
 
     def stop(self):
         if self.srv: self.srv.kill()
         self.gr.kill()
+        self.sweeper.kill()
+        self.ticker.kill()
+        self.refresher.kill()
+        for c in self.clients.itervalues(): c.close()
+
+    def tick(self):
+        while True:
+            gevent.sleep(PendingTable.TICK)
+            ids = self.inquery.tick()
+            if ids: logger.info('%d dns queries timeout' % len(ids))
+
+    def final(self):
+        if self.snapshot: self.savesnapshot(self.snapshot)
+
+    def sweep(self):
+        lastsave = time.time()
+        while True:
+            gevent.sleep(self.SWEEP)
+            n = self.cache.expire()
+            if n: logger.debug('%d dns records expired' % n)
+            if self.snapshot and time.time() - lastsave >= self.SNAPSHOT:
+                self.savesnapshot(self.snapshot)
+                lastsave = time.time()
+
+    def setcache(self, name, ipaddrs, ttl, type=TYPE.A, rcode=RCODE.NOERROR, keep=1):
+        ''' key: (name, type),
+        record: [expire, ipaddrs, hits, scores, rcode, ttl expire],
+        scores: connect scoreboard of each address, rcode: NXDOMAIN or not.
+        records with addresses are kept keep times ttl, but answered within ttl.
+        hits and loss of addresses still there decay by half at each update. '''
+        key, t = (name, type), time.time()
+        expire, old = t + ttl * (keep if ipaddrs else 1), self.cache.get(key)
+        scores = {}
+        if old:
+            for ip in ipaddrs:
+                if ip not in old[3]: continue
+                scores[ip] = old[3][ip]
+                scores[ip].loss /= 2
+        r = [expire, ipaddrs, old[2] / 2 if old else 0, scores, rcode, t + ttl]
+        self.cache.set(key, r, expire + max(self.stale, self.GRACE))
+
+    def loadsnapshot(self, filepath):
+        openfile = open
+        if filepath.endswith('.gz'):
+            import gzip
+            openfile = gzip.open
+        t, count = time.time(), 0
+        try:
+            with openfile(filepath) as fi:
+                for line in fi:
+                    try: r = self.parsesnapshot(line, t)
+                    except (ValueError, IndexError):
+                        logger.debug('bad dns snapshot line: %r' % line)
+                        continue
+                    if r is None: continue
+                    self.cache.set(*r)
+                    count += 1
+        except (OSError, IOError): return False
+        logger.info('%d dns records loaded from %s' % (count, filepath))
+        return True
+
+    def parsesnapshot(self, line, t):
+        r = line.strip().split('\t')
+        name, expire, ipaddrs = r[:3]
+        type = int(r[3]) if len(r) > 3 else TYPE.A
+        rcode = int(r[4]) if len(r) > 4 else RCODE.NOERROR
+        # unknown ttl of old snapshots, forward instead of answering locally.
+        ttlexpire = float(r[5]) if len(r) > 5 else t
+        expire = float(expire)
+        deadline = expire + max(self.stale, self.GRACE)
+        if deadline <= t: return
+        ipaddrs = ipaddrs.split(',') if ipaddrs else []
+        return (name, type), [expire, ipaddrs, 0, {}, rcode, ttlexpire], deadline
+
+    def savesnapshot(self, filepath):
+        openfile = open
+        if filepath.endswith('.gz'):
+            import gzip
+            openfile = gzip.open
+        t = time.time()
+        try:
+            if path.dirname(filepath) and not path.isdir(path.dirname(filepath)):
+                os.makedirs(path.dirname(filepath))
+            with openfile(filepath + '.tmp', 'w+') as fo:
+                for (name, type), r, deadline in self.cache.items():
+                    if deadline <= t: continue
+                    fo.write('%s\t%0.0f\t%s\t%d\t%d\t%0.0f\n' % (
+                            name, r[0], ','.join(r[1]), type, r[4], r[5]))
+            os.rename(filepath + '.tmp', filepath)
+        except (OSError, IOError):
+            logger.warn('save dns snapshot to %s failed' % filepath)
+            return False
+        return True
 
     def load(self, stream):
         for line in stream:
@@ -129,83 +368,229 @@ class DNSServer(object):
         except (OSError, IOError): return False
 
     def get_ipaddrs(self, r):
-        ipaddrs = [rdata for name, type, cls, ttl, rdata in r.ans if type == TYPE.A]
+        ''' return addresses and ttl of the type in quiz, None to drop r.
+        no such name, or no address of the type, is a valid empty answer. '''
+        qtype = r.quiz[0][1] if r.quiz else TYPE.A
+        ipaddrs = [rdata for name, type, cls, ttl, rdata in r.ans if type == qtype]
         if not ipaddrs:
-            logger.info('drop an empty dns response.')
+            if r.rcode in (RCODE.NOERROR, RCODE.NXDOMAIN): return [], self.NEGATIVE
+            logger.info('drop an empty dns response with rcode %d.' % r.rcode)
             return
         if self.fakeset and self.fakeset & set(ipaddrs):
             logger.info('drop %s in fakeset.' % ipaddrs)
             return
-        ttls = [ttl for name, type, cls, ttl, rdata in r.ans if type == TYPE.A]
-        return ipaddrs, ttls[0] * 60 if ttls else self.TIMEOUT
+        ttls = [ttl for name, type, cls, ttl, rdata in r.ans if type == qtype]
+        return ipaddrs, ttls[0] if ttls else self.TIMEOUT
+
+    def lookup(self, name, type=TYPE.A):
+        ''' return record of name in cache, or query it. None if failed. '''
+        key = (name, type)
+        t, r = time.time(), self.cache.get(key)
+        if r is not None:
+            r[2] += 1
+            if r[0] >= t:
+                if r[0] - t < self.REFRESH and r[2] >= self.HOTHITS: self.refresh(name, type)
+                return r
+            if t - r[0] < self.GRACE and self.refresh(name, type):
+                self.stats['grace'] += 1
+                return r
+
+        self.query(name, type)
+        # a stale record is still there if query failed.
+        r = self.cache.get(key)
+        if r is None or r[0] + self.stale < time.time(): return None
+        return r
+
+    def ranked(self, r):
+        ''' addresses of record r, those not measured yet first, then the best
+        scored. shuffled at EXPLORE times, to give the others a chance. '''
+        if r is None: return []
+        ipaddrs, scores = list(r[1]), r[3]
+        random.shuffle(ipaddrs)
+        if random.random() >= self.EXPLORE:
+            ipaddrs.sort(key=lambda ip: scores[ip].score() if ip in scores else 0)
+        return ipaddrs
+
+    def report(self, name, ip, rtt=None):
+        ''' feed the connect rtt of ip of name, None if failed. '''
+        r = self.cache.get((name, TYPE.AAAA if ':' in ip else TYPE.A))
+        if r is None or ip not in r[1]: return
+        s = r[3].get(ip)
+        if s is None: s = r[3][ip] = Scoreboard()
+        if rtt is None: s.lost()
+        else: s.answered(rtt)
 
     def gethostbyname(self, name):
         try:
             socket.inet_aton(name)
             return name
         except socket.error: pass
-
-        if name in self.cache:
-            if time.time() <= self.cache[name][0]:
-                return random.choice(self.cache[name][1])
-            else: del self.cache[name]
-
-        self.query(name)
-        r = self.cache.get(name)
-        if r is None: return None
-        else: return random.choice(r[1])
+        ipaddrs = self.ranked(self.lookup(name))
+        return ipaddrs[0] if ipaddrs else None
+
+    def getaddrs(self, name):
+        ''' return ipv6 and ipv4 addresses of name interleaved, ipv6 first,
+        the best scored first in each family.
+        AAAA is waited for RESOLVE_DELAY at most after A is answered. '''
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                socket.inet_pton(family, name)
+                return [name,]
+            except socket.error: pass
+        gr6 = gevent.spawn(self.lookup, name, TYPE.AAAA)
+        addrs4 = self.ranked(self.lookup(name))
+        gr6.join(self.RESOLVE_DELAY)
+        addrs6 = self.ranked(gr6.value) if gr6.ready() else []
+        r = []
+        for i in xrange(max(len(addrs4), len(addrs6))):
+            r.extend(addrs6[i:i+1] + addrs4[i:i+1])
+        return r
+
+    def refresh(self, name, type=TYPE.A):
+        ''' query name in background, return False if too many refreshes. '''
+        if (name, type) in self.inflight: return True
+        if self.refresher.full(): return False
+        self.stats['refresh'] += 1
+        self.refresher.spawn(self.background_query, name, type)
+        return True
+
+    def background_query(self, name, type=TYPE.A):
+        try: self.query(name, type)
+        except Exception, err: logger.warn('refresh %s failed: %s' % (name, err))
 
     @contextmanager
-    def with_queue(self, id):
+    def with_queue(self):
         qp = queue.Queue()
+        callback = lambda r, d, addr: qp.put((r, addr))
+        id = self.inquery.add(callback, self.timeout)
+        if id is None: raise Exception('too many pending dns queries')
         logger.debug('add id %d' % id)
-        self.inquery[id] = lambda r, d: qp.put(r)
-        try: yield qp
-        finally: del self.inquery[id]
+        try: yield id, qp
+        finally:
+            # the id may have expired and been given to another query.
+            if self.inquery.get(id) is callback: self.inquery.pop(id)
         logger.debug('del id %d' % id)
 
     def query(self, name, type=TYPE.A):
-        q = mkquery((name, type))
-        while q.id in self.inquery: q = mkquery((name, type))
-        logger.debug('request dns %s with id %d' % (name, q.id))
-        with self.with_queue(q.id) as qp:
-            self.sock.sendto(q.pack(), (self.dnsserver, self.DNSPORT))
-            for i in xrange(self.RETRY):
-                try:
-                    r = qp.get(timeout=self.timeout)
-                    logger.debug('get response with id: %d' % r.id)
-                    ipaddrs, ttl = self.get_ipaddrs(r)
-                    self.cache[name] = (time.time() + ttl, ipaddrs)
-                    return
-                except (EOFError, socket.error): continue
-                except queue.Empty: return
+        ''' query name and fill cache. concurrent queries of the same name
+        and type wait for the first one instead of sending their own. '''
+        key = (name, type)
+        ar = self.inflight.get(key)
+        if ar is not None:
+            self.stats['coalesced'] += 1
+            return ar.get()
+        ar = self.inflight[key] = event.AsyncResult()
+        self.stats['upstream'] += 1
+        try:
+            r = self.do_query(name, type)
+            ar.set(r)
+            return r
+        except Exception, err:
+            ar.set_exception(err)
+            raise
+        finally: del self.inflight[key]
+
+    def select(self, name):
+        ''' upstreams for name, remotes if name is in domains. '''
+        if self.remotes and self.domains is not None and name in self.domains:
+            self.stats['remote'] += 1
+            return self.remotes
+        return self.upstreams
+
+    def best_upstream(self, name): return min(self.select(name), key=lambda u: u.score())
+
+    def do_query(self, name, type=TYPE.A):
+        ''' send to upstreams from the best one, each after the rto of the last,
+        and double the rto after each round. the first valid answer wins. '''
+        q, sent = mkquery((name, type)), {}
+        upstreams = sorted(self.select(name), key=lambda u: u.score())
+        deadline, i, rto = time.time() + self.timeout, 0, upstreams[0].rto()
+        with self.with_queue() as (q.id, qp):
+            logger.debug('request dns %s with id %d' % (name, q.id))
+            data = q.pack()
+            while True:
+                t = time.time()
+                if t >= deadline: break
+                u = upstreams[i % len(upstreams)]
+                if u not in sent: self.send(u, data); sent[u] = t
+                elif u not in self.clients: # tcp does not lose it
+                    self.send(u, data)
+                    sent[u] = None # retransmitted, rtt is ambiguous
+                i += 1
+                if i % len(upstreams) == 0: rto *= 2
+                try: r, addr = qp.get(timeout=min(rto, deadline - t))
+                except queue.Empty: continue
+                logger.debug('get response with id: %d from %s' % (r.id, addr[0]))
+                t = time.time()
+                winner = [u for u in upstreams if u.addr == addr]
+                if winner and winner[0] in sent:
+                    u = winner[0]
+                    u.answered(t - sent[u] if sent[u] is not None else None)
+                    for o, st in sent.iteritems():
+                        if o is not u and (st is None or sent[u] is None or st < sent[u]):
+                            o.lost()
+                self.setcache(name, *self.get_ipaddrs(r), type=type, rcode=r.rcode,
+                              keep=self.KEEP)
+                return
+        for u in sent: u.lost()
+
+    def send(self, u, data):
+        c = self.clients.get(u)
+        if c is None: self.sock.sendto(data, u.addr)
+        else: c.send(struct.unpack('>H', data[:2])[0], data)
+
+    def on_answer(self, d, addr):
+        # late answers of raced queries come here, drop them before parsing.
+        id = struct.unpack_from('>H', d)[0]
+        callback = self.inquery.get(id)
+        if callback is None:
+            logger.debug('got a record %d not in query' % id)
+            return
+        r = Record.unpack(d, PARSE.ANSWER)
+        if self.get_ipaddrs(r): callback(r, d, addr)
 
     def receiver(self):
         while True:
             try:
-                while True:
-                    d = self.sock.recvfrom(2048)[0]
-                    r = Record.unpack(d)
-                    if not self.get_ipaddrs(r): continue
-                    if r.id not in self.inquery:
-                        logger.warn('got a record not in query\n')
-                        for line in r.show(): logger.warn(line)
-                    else: self.inquery[r.id](r, d)
+                while True: self.on_answer(*self.sock.recvfrom(2048))
             except Exception, err: logger.exception(err)
 
+    def answer(self, q):
+        ''' answer a query from cache, return None if not cached. '''
+        if q.qr or q.opcode != OPCODE.QUERY or len(q.quiz) != 1: return
+        name, type, cls = q.quiz[0]
+        if type not in (TYPE.A, TYPE.AAAA) or cls != CLASS.IN: return
+        t, r = time.time(), self.cache.get((name.lower(), type))
+        # past its real ttl, forward it and let the answer refill cache.
+        if r is None or min(r[0], r[5]) <= t: return
+        r[2] += 1
+        res = Record(q.id, 1, q.opcode, 0, 0, q.rd, 1, r[4])
+        res.quiz = q.quiz
+        ttl = max(int(min(r[0], r[5]) - t), 1)
+        res.ans = [(name, type, CLASS.IN, ttl, ip) for ip in r[1]]
+        return res.pack()
+
     def on_datagram(self, data, sock, addr):
-        q = Record.unpack(data)
-        if q.id in self.inquery:
-            logger.warn('dns id %d conflict.' % q.id)
+        q = Record.unpack(data, PARSE.ANSWER)
+        d = self.answer(q)
+        if d is not None:
+            self.stats['local'] += 1
+            sock.sendto(d, addr)
             return
 
-        # TODO: timeout!
-        def sendback(r, d):
-            assert r.id==q.id
-            sock.sendto(d, addr)
-            del self.inquery[q.id]
-        self.inquery[q.id] = sendback
-        self.sock.sendto(data, (self.dnsserver, self.DNSPORT))
+        cid = q.id
+        def sendback(r, d, upaddr):
+            self.inquery.pop(id)
+            sock.sendto(data[:2] + d[2:], addr)
+            if r.quiz and r.quiz[0][1] in (TYPE.A, TYPE.AAAA):
+                self.setcache(r.quiz[0][0].lower(), *self.get_ipaddrs(r),
+                              type=r.quiz[0][1], rcode=r.rcode, keep=self.KEEP)
+        id = self.inquery.add(sendback, self.timeout, cid)
+        if id is None:
+            logger.warn('too many pending dns queries, drop %d.' % cid)
+            return
+        name = q.quiz[0][0].lower() if q.quiz else ''
+        self.send(self.best_upstream(name), struct.pack('>H', id) + data[2:])
 
     def server(self, port=53):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -219,52 +604,95 @@ class DNSServer(object):
                     self.on_datagram(data, sock, addr)
             except Exception, err: logger.exception(err)
 
-class TCPDNSServer(DNSServer):
+class TCPDNSConn(object):
+    ''' one tcp connection, the writer sends queued queries in batch,
+    the reader hands answers back to client in any order. '''
 
-    def __init__(self, dnsserver, cmanager=None, cachesize=512, timeout=30):
-        self.dnsserver = dnsserver or self.DNSSERVER
-        self.cache, self.cachesize = ObjHeap(cachesize), cachesize
-        self.timeout = timeout
-        self.fakeset = set()
-        self.cmanager = cmanager
-        if self.cmanager is None: self.cmanager = conn.DirectManager(self.dns)
-    
-    def query(self, name, type=TYPE.A):
-        q = mkquery((name, type))
-        while q.id in self.inquery: q = mkquery((name, type))
-        logger.debug('request dns %s with id %d in tcp' % (name, q.id))
+    def __init__(self, client):
+        self.client, self.outstanding = client, {}
+        self.q, self.connected = queue.Queue(), False
+        self.gr = gevent.spawn(self.run)
 
-        with self.cmanager.socket() as sock:
-            stream = sock.makefile()
+    def send(self, id, data):
+        self.outstanding[id] = (data, time.time())
+        self.q.put(struct.pack('>H', len(data)) + data)
 
-            data = q.pack()
-            stream.write(struct.pack('!H', len(data)) + data)
-            stream.flush()
-            s = stream.read(2)
-            if len(s) == 0: raise EOFError()
-            count = struct.unpack('!H', s)[0]
-            reply = stream.read(count)
-            if len(reply) == 0: raise EOFError()
-
-            r = Record.unpack(reply)
-            ips = self.get_ipaddrs(r)
-            if ips is None: raise Exception('get fake ip in tcp mode?')
-            ipaddrs, ttl = ips
-            self.cache[name] = (time.time() + ttl, ipaddrs)
-
-    def on_datagram(self, data, sock, addr):
-        q = Record.unpack(data)
-
-        with self.cmanager.socket() as sock:
-            stream = sock.makefile()
+    def run(self):
+        try:
+            with self.client.cmanager.socket() as sock:
+                sock.connect(self.client.addr)
+                self.connected = True
+                rd = gevent.spawn(self.reader, sock.makefile('rb'))
+                try:
+                    while True:
+                        buf = [self.q.get()]
+                        while not self.q.empty(): buf.append(self.q.get_nowait())
+                        if None in buf: break
+                        sock.sendall(''.join(buf))
+                finally: sock.close()
+                rd.join()
+        except Exception, err:
+            logger.info('dns connection to %s:%d broken: %s' % (self.client.addr + (err,)))
+        finally: self.client.broken(self)
+
+    def reader(self, stream):
+        try:
+            while True:
+                d = stream.read(2)
+                if len(d) < 2: break
+                d = stream.read(struct.unpack('>H', d)[0])
+                self.outstanding.pop(struct.unpack('>H', d[:2])[0], None)
+                self.client.callback(d, self.client.addr)
+        except Exception, err: logger.debug('dns connection read: %s' % err)
+        finally: self.q.put(None)
+
+    def close(self): self.q.put(None)
+
+class TCPDNSClient(object):
+    ''' dns over tcp on a few long lived connections from cmanager.
+    queries are pipelined and answers go to callback(d, addr), to be matched
+    by id. a broken connection is dropped and queries on it are sent again
+    on a new one, if it ever worked. '''
+
+    def __init__(self, addr, cmanager, callback, size=2, timeout=30):
+        self.addr, self.cmanager, self.callback = addr, cmanager, callback
+        self.size, self.timeout = size, timeout
+        self.conns, self.reconnects = [], 0
+
+    def send(self, id, data):
+        if len(self.conns) < self.size:
+            c = TCPDNSConn(self)
+            self.conns.append(c)
+        else: c = min(self.conns, key=lambda c: len(c.outstanding))
+        if len(c.outstanding) > 256: self.prune(c)
+        c.send(id, data)
+
+    def prune(self, c):
+        t = time.time() - self.timeout
+        for id, (data, st) in c.outstanding.items():
+            if st < t: del c.outstanding[id]
+
+    def broken(self, c):
+        if c in self.conns: self.conns.remove(c)
+        else: return # closed
+        if not c.connected: return
+        self.prune(c)
+        if not c.outstanding: return
+        self.reconnects += 1
+        for id, (data, st) in c.outstanding.iteritems(): self.send(id, data)
+
+    def close(self):
+        conns, self.conns = self.conns, []
+        for c in conns: c.close()
+
+    def stat(self):
+        return '%s:%d tcp %d conns %d pending %d reconnects' % (
+            self.addr + (len(self.conns), sum(len(c.outstanding) for c in self.conns),
+                         self.reconnects))
 
-            s = struct.pack('!H', len(data))
-            stream.write(s+data)
-            stream.flush()
-            s = stream.read(2)
-            if len(s) == 0: raise EOFError()
-            count = struct.unpack('!H', s)[0]
-            reply = stream.read(count)
-            if len(reply) == 0: raise EOFError()
+class TCPDNSServer(DNSServer):
+    ''' query all upstreams in tcp through cmanager, which is a proxy usually. '''
 
-            sock.sendto(reply, d)
+    def __init__(self, dnsserver, cmanager=None, cachesize=512, timeout=30, conns=2, **kw):
+        super(TCPDNSServer, self).__init__(dnsserver, cachesize, timeout, **kw)
+        self.tcpclients(self.upstreams, cmanager, conns)
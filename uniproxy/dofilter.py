@@ -4,60 +4,88 @@
 @date: 2012-04-26
 @author: shell.xu
 '''
-import sys, logging
+import re, sys, base64, logging, itertools
 
 __all__ = ['DomainFilter']
 logger = logging.getLogger('dofilter')
 
+def normalize(domain):
+    return '.'.join([c.strip() for c in domain.lower().split('.') if c.strip()])
+
+def b64lines(stream):
+    ''' decode base64 stream on the fly, yield text lines. '''
+    rest, text = '', ''
+    for chunk in stream:
+        rest += ''.join(chunk.split())
+        n = len(rest) / 4 * 4
+        text, rest = text + base64.b64decode(rest[:n]), rest[n:]
+        lines = text.split('\n')
+        text = lines.pop()
+        for line in lines: yield line
+    if rest: text += base64.b64decode(rest + '=' * (-len(rest) % 4))
+    if text: yield text
+
+b64_re = re.compile('^[A-Za-z0-9+/]+=*$')
+domain_end_re = re.compile('[/:^?$|]')
+def parse_rule(line):
+    ''' parse one adblock/autoproxy rule, return (domain, exception) or None.
+    ||domain, |http://domain/path, .domain, domain/path are all domain rules.
+    comments, regex rules and wildcard hosts are ignored. '''
+    line = line.strip()
+    if not line or line[0] in '![': return
+    exception = line.startswith('@@')
+    if exception: line = line[2:]
+    if line.startswith('/'): return
+    if line.startswith('||'): line = line[2:]
+    else: line = line.lstrip('|').split('://', 1)[-1]
+    domain = domain_end_re.split(line, 1)[0].lstrip('.*')
+    if '*' in domain or '.' not in domain: return
+    return normalize(domain), exception
+
 class DomainFilter(object):
+    ''' domain rules as a set of normalized suffixes.
+    lookup probes the suffixes of a hostname from the shortest to the longest. '''
 
-    def __init__(self): self.domains = {}
-    def empty(self): self.domains = {}
+    def __init__(self): self.domains, self.excepts = set(), set()
+    def empty(self): self.domains, self.excepts = set(), set()
 
     def add(self, domain):
-        doptr, chunk, domain = self.domains, domain.split('.'), domain.lower()
-        for c in reversed(chunk):
-            if len(c.strip()) == 0: continue
-            if c not in doptr or doptr[c] is None: doptr[c] = {}
-            lastptr, doptr = doptr, doptr[c]
-        if len(doptr) == 0: lastptr[c] = None
+        domain = normalize(domain)
+        if domain: self.domains.add(domain)
 
     def remove(self, domain):
-        doptr, stack, chunk = self.domains, [], domain.split('.')
-        for c in reversed(chunk):
-            if len(c.strip()) == 0: raise LookupError()
-            if doptr is None: return False
-            stack.append(doptr)
-            if c not in doptr: return False
-            doptr = doptr[c]
-        for doptr, c in zip(reversed(stack), chunk):
-            if doptr[c] is None or len(doptr[c]) == 0: del doptr[c]
+        chunk = domain.lower().split('.')
+        if any(len(c.strip()) == 0 for c in chunk): raise LookupError()
+        domain = '.'.join([c.strip() for c in chunk])
+        if domain not in self.domains: return False
+        self.domains.remove(domain)
         return True
 
-    def __getitem__(self, domain):
-        doptr, chunk = self.domains, domain.split('.')
-        for c in reversed(chunk):
-            if len(c.strip()) == 0: continue
-            if c not in doptr: return False
-            doptr = doptr[c]
-            if doptr is None: break
-        return doptr
-    def __contains__(self, domain): return self.__getitem__(domain) is None
-
-    def getlist(self, d = None, s = ''):
-        if d is None: d = self.domains
-        for k, v in d.items():
-            t = '%s.%s' %(k, s)
-            if v is None: yield t.strip('.')
-            else:
-                for i in self.getlist(v, t): yield i
-
-    def show(self, d = None, s = 0):
-        if d is None: d = self.domains
-        for k, v in d.items():
-            yield '  '*s + k
-            if v is not None:
-                for i in self.show(v, s + 1): yield i
+    def match(self, domain):
+        ''' return the rule which domain matched, or None.
+        a matched exception rule overrides any domain rule. '''
+        domains, excepts = self.domains, self.excepts
+        domain, r = domain.lower().rstrip('.'), None
+        i = len(domain)
+        while i > 0:
+            i = domain.rfind('.', 0, i)
+            suffix = domain[i+1:]
+            if suffix in excepts: return None
+            if r is None and suffix in domains:
+                if not excepts: return suffix
+                r = suffix
+        return r
+    def __contains__(self, domain): return self.match(domain) is not None
+
+    def getlist(self): return iter(self.domains)
+
+    def show(self):
+        last = []
+        for chunk in sorted([d.split('.')[::-1] for d in self.domains]):
+            n = 0
+            while n < min(len(last), len(chunk)) and last[n] == chunk[n]: n += 1
+            for i in xrange(n, len(chunk)): yield '  '*i + chunk[i]
+            last = chunk
 
     def load(self, stream):
             for line in stream:
@@ -73,6 +101,29 @@ class DomainFilter(object):
             with openfile(filepath, 'r') as fi: self.load(fi)
         except (OSError, IOError): return False
 
+    def loadrules(self, stream):
+        ''' load adblock style rules, such as gfwlist, plain or base64 encoded.
+        exception rules (@@) go to excepts. '''
+        for first in stream:
+            if first.strip(): break
+        else: return
+        stream = itertools.chain([first], stream)
+        if b64_re.match(first.strip()): stream = b64lines(stream)
+        for line in stream:
+            r = parse_rule(line)
+            if r is None: continue
+            if r[1]: self.excepts.add(r[0])
+            else: self.domains.add(r[0])
+
+    def loadrulefile(self, filepath):
+        openfile = open
+        if filepath.endswith('.gz'):
+            import gzip
+            openfile = gzip.open
+        try:
+            with openfile(filepath, 'r') as fi: self.loadrules(fi)
+        except (OSError, IOError): return False
+
     def save(self, stream):
         for line in sorted(self.getlist()): stream.write(line+'\n')
 
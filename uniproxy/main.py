@@ -4,7 +4,7 @@
 @date: 2012-05-25
 @author: shell.xu
 '''
-import sys, logging, gevent, serve, hoh, mgr
+import sys, signal, logging, gevent, serve, hoh, mgr
 from os import path
 from gevent import server
 
@@ -29,8 +29,12 @@ def main(*cfgs):
     initlog(getattr(logging, ps.config.get('loglevel', 'WARNING')))
     logger.info('ProxyServer inited')
     addr = (ps.config.get('localip', ''), ps.config.get('localport', 8118))
+    srv = server.StreamServer(addr, ps.http_handler)
+    # watcher stops us by SIGTERM, stop serving so final() saves snapshot.
+    sighandler = getattr(gevent, 'signal_handler', None) or gevent.signal
+    sighandler(signal.SIGTERM, srv.stop)
     try:
-        try: server.StreamServer(addr, ps.http_handler).serve_forever()
+        try: srv.serve_forever()
         except KeyboardInterrupt: pass
     finally: ps.final()
 
@@ -31,8 +31,20 @@ socks_stat = template.Template(template='''
     {%if ps.whitenf:%}<td><a href="/whitenets">whitenets</a></td>{%end%}
     {%if ps.blacknf:%}<td><a href="/blacknets">blacknets</a></td>{%end%}
   </tr>
-  <tr><td>dns cache</td></tr>
-  <tr><td>{%=len(ps.dns.cache)%}/{%=ps.dns.cachesize%}</td></tr>
+  <tr><td>dns cache</td><td>route cache</td></tr>
+  <tr>
+    <td>{%=len(ps.dns.cache)%}/{%=ps.dns.cachesize%}</td>
+    <td>{%=ps.routes.stat()%}</td>
+  </tr>
+  {%for k, v in sorted(ps.dns.stats.items()):%}
+    <tr><td>dns {%=k%}</td><td>{%=v%}</td></tr>
+  {%end%}
+  {%for u in ps.dns.upstreams + ps.dns.remotes:%}
+    <tr><td>dns upstream</td><td>{%=u.stat()%}</td></tr>
+  {%end%}
+  {%for c in ps.dns.clients.values():%}
+    <tr><td>dns tcp</td><td>{%=c.stat()%}</td></tr>
+  {%end%}
 </table><p/>
 <table>
   <tr><td>socks</td><td>stat</td></tr>
@@ -4,7 +4,7 @@
 @date: 2012-09-27
 @author: shell.xu
 '''
-import sys, struct, random, logging, cStringIO
+import sys, struct, random, logging
 from gevent import socket
 
 logger = logging.getLogger('dns')
@@ -28,6 +28,14 @@ class OPCODE(DEFINE):
     NOTIFY = 4
     UPDATE = 5
 
+class RCODE(DEFINE):
+    NOERROR = 0
+    FORMERR = 1
+    SERVFAIL = 2
+    NXDOMAIN = 3
+    NOTIMP = 4
+    REFUSED = 5
+
 # with NULL, cython can't compile this file
 class TYPE(DEFINE):
     A = 1           # a host address
@@ -67,8 +75,13 @@ class CLASS(DEFINE):
     HS = 4          # Hesiod [Dyer 87]
     ANY = 255       # any class
 
+class PARSE(DEFINE):
+    HEADER = 0      # id and flags only
+    ANSWER = 1      # and quiz and answer sections
+    ALL = 2
+
 def packbit(r, bit, dt): return r << bit | (dt & (2**bit - 1))
-def unpack(r, bit): return r & (2**bit - 1), r >> bit
+def unpack(r, bit): return r >> bit, r & (2**bit - 1)
 
 def packflag(qr, opcode, auth, truncated, rd, ra, rcode):
     r = packbit(packbit(0, 1, qr), 4, opcode)
@@ -78,15 +91,14 @@ def packflag(qr, opcode, auth, truncated, rd, ra, rcode):
     return r
 
 def unpackflag(r):
-    r, qr = unpack(r, 1)
-    r, opcode = unpack(r, 4)
-    r, auth = unpack(r, 1)
-    r, truncated = unpack(r, 1)
-    r, rd = unpack(r, 1)
-    r, ra = unpack(r, 1)
-    r, rv = unpack(r, 3)
     r, rcode = unpack(r, 4)
-    assert rv == 0
+    r, rv = unpack(r, 3)
+    r, ra = unpack(r, 1)
+    r, rd = unpack(r, 1)
+    r, truncated = unpack(r, 1)
+    r, auth = unpack(r, 1)
+    r, opcode = unpack(r, 4)
+    r, qr = unpack(r, 1)
     return qr, opcode, auth, truncated, rd, ra, rcode
 
 class Record(object):
@@ -108,87 +120,132 @@ class Record(object):
 
     def filteredRR(self, RRs, types): return (i for i in RRs if i[0] in types)
 
-    def packname(self, name):
-        return ''.join([chr(len(i))+i for i in name.split('.')]) + '\x00'
+    def packname(self, name, offset=None):
+        ''' with offset, name is compressed against names packed before. '''
+        if offset is None:
+            return ''.join([chr(len(i))+i for i in name.split('.')]) + '\x00'
+        r, labels = [], [i for i in name.split('.') if i]
+        for i, label in enumerate(labels):
+            suffix = '.'.join(labels[i:]).lower()
+            if suffix in self.names:
+                r.append(struct.pack('>H', 0xC000 | self.names[suffix]))
+                return ''.join(r)
+            if offset < 0x4000: self.names[suffix] = offset
+            r.append(chr(len(label)) + label)
+            offset += 1 + len(label)
+        r.append('\x00')
+        return ''.join(r)
 
-    def unpackname(self, s):
-        r = []
-        c = ord(s.read(1))
-        while c != 0:
+    def unpackname(self, off):
+        ''' return name at off and the offset after it.
+        names are cached by offset, for pointers to them. '''
+        buf, names, r, jumps, start, end = self.buf, self.names, [], [], off, None
+        for i in xrange(256): # a name has 127 labels at most, pointers may loop.
+            c = ord(buf[off])
             if c & 0xC0 == 0xC0:
-                c = (c << 8) + ord(s.read(1)) & 0x3FFF
-                r.append(self.unpackname(cStringIO.StringIO(self.buf[c:])))
+                if end is None: end = off + 2
+                off = struct.unpack_from('>H', buf, off)[0] & 0x3FFF
+                if off in names:
+                    r.append(names[off])
+                    break
+                jumps.append((off, len(r)))
+            elif c == 0:
+                if end is None: end = off + 1
                 break
-            else: r.append(s.read(c))
-            c = ord(s.read(1))
-        return '.'.join(r)
+            else:
+                r.append(buf[off+1:off+1+c])
+                off += 1 + c
+        else: raise Exception('dns name looped.')
+        name = names[start] = '.'.join(r)
+        for off, i in jumps: names[off] = '.'.join(r[i:])
+        return name, end
 
-    def packquiz(self, name, qtype, cls):
-        return self.packname(name) + struct.pack('>HH', qtype, cls)
+    def packquiz(self, offset, name, qtype, cls):
+        return self.packname(name, offset) + struct.pack('>HH', qtype, cls)
 
-    def unpackquiz(self, s):
-        name, r = self.unpackname(s), struct.unpack('>HH', s.read(4))
-        return name, r[0], r[1]
+    def unpackquiz(self, off):
+        name, off = self.unpackname(off)
+        type, cls = struct.unpack_from('>HH', self.buf, off)
+        return (name, type, cls), off + 4
 
     def showquiz(self, q):
         return '\t%s\t%s\t%s' % (q[0], TYPE.lookup(q[1]), CLASS.lookup(q[2]))
 
-    # def packRR(self, name, type, cls, ttl, res):
-    #     return self.packname(name) + \
-    #         struct.pack('>HHIH', type, cls, ttl, len(res)) + res
-
-    def unpackRR(self, s):
-        n = self.unpackname(s)
-        r = struct.unpack('>HHIH', s.read(10))
-        if r[0] == TYPE.A:
-            return n, r[0], r[1], r[2], socket.inet_ntoa(s.read(r[3]))
-        elif r[0] == TYPE.CNAME:
-            return n, r[0], r[1], r[2], self.unpackname(s)
-        elif r[0] == TYPE.MX:
-            return n, r[0], r[1], r[2], \
-                struct.unpack('>H', s.read(2))[0], self.unpackname(s)
-        elif r[0] == TYPE.PTR:
-            return n, r[0], r[1], r[2], self.unpackname(s)
-        elif r[0] == TYPE.SOA:
-            rr = [n, r[0], r[1], r[2], self.unpackname(s), self.unpackname(s)]
-            rr.extend(struct.unpack('>IIIII', s.read(20)))
-            return tuple(rr)
-        else: raise Exception("don't know howto handle type, %s." % str(r))
+    def packRR(self, offset, name, type, cls, ttl, *rdata):
+        n = self.packname(name, offset)
+        offset += len(n) + 10
+        if type == TYPE.A: rd = socket.inet_aton(rdata[0])
+        elif type == TYPE.AAAA: rd = socket.inet_pton(socket.AF_INET6, rdata[0])
+        elif type in (TYPE.CNAME, TYPE.PTR, TYPE.NS): rd = self.packname(rdata[0], offset)
+        elif type == TYPE.MX:
+            rd = struct.pack('>H', rdata[0]) + self.packname(rdata[1], offset + 2)
+        elif type == TYPE.SOA:
+            rd = self.packname(rdata[0], offset)
+            rd += self.packname(rdata[1], offset + len(rd))
+            rd += struct.pack('>IIIII', *rdata[2:])
+        else: rd = rdata[0]
+        return n + struct.pack('>HHIH', type, cls, ttl, len(rd)) + rd
+
+    def unpackRR(self, off):
+        ''' return rr at off and the offset after it.
+        rdata of types unknown is kept in raw. '''
+        buf = self.buf
+        n, off = self.unpackname(off)
+        type, cls, ttl, rdlen = struct.unpack_from('>HHIH', buf, off)
+        off += 10
+        end = off + rdlen
+        if end > len(buf): raise Exception('dns rr truncated.')
+        if type == TYPE.A: rd = (socket.inet_ntoa(buf[off:end]),)
+        elif type == TYPE.AAAA: rd = (socket.inet_ntop(socket.AF_INET6, buf[off:end]),)
+        elif type in (TYPE.CNAME, TYPE.PTR, TYPE.NS): rd = (self.unpackname(off)[0],)
+        elif type == TYPE.MX:
+            rd = (struct.unpack_from('>H', buf, off)[0], self.unpackname(off + 2)[0])
+        elif type == TYPE.SOA:
+            mname, off = self.unpackname(off)
+            rname, off = self.unpackname(off)
+            rd = (mname, rname) + struct.unpack_from('>IIIII', buf, off)
+        else: rd = (buf[off:end],)
+        return (n, type, cls, ttl) + rd, end
 
     def showRR(self, r):
-        if r[1] in (TYPE.A, TYPE.CNAME, TYPE.PTR, TYPE.SOA):
-            return '\t%s\t%d\t%s\t%s\t%s' % (
-                r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1]), r[4])
-        elif r[1] == TYPE.MX:
-            return '\t%s\t%d\t%s\t%s\t%s' % (
-                r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1]), r[5])
-        else: raise Exception("don't know howto handle type, %s." % str(r))
+        if r[1] == TYPE.MX: rd = '%d %s' % r[4:6]
+        elif r[1] == TYPE.SOA: rd = ' '.join(map(str, r[4:]))
+        elif r[1] in (TYPE.A, TYPE.AAAA, TYPE.CNAME, TYPE.PTR, TYPE.NS): rd = r[4]
+        else: rd = repr(r[4])
+        return '\t%s\t%d\t%s\t%s\t%s' % (
+            r[0], r[3], CLASS.lookup(r[2]), TYPE.lookup(r[1], r[1]), rd)
 
     def pack(self):
+        self.names = {}
         self.buf = struct.pack(
             '>HHHHHH', self.id, packflag(self.qr, self.opcode, self.authans,
                                          self.truncated, self.rd, self.ra, self.rcode),
             len(self.quiz), len(self.ans), len(self.auth), len(self.ex))
-        for i in self.quiz: self.buf += self.packquiz(*i)
-        for i in self.ans: self.buf += self.packRR(*i)
-        for i in self.auth: self.buf += self.packRR(*i)
-        for i in self.ex: self.buf += self.packRR(*i)
+        for i in self.quiz: self.buf += self.packquiz(len(self.buf), *i)
+        for i in self.ans + self.auth + self.ex: self.buf += self.packRR(len(self.buf), *i)
         return self.buf
 
     @classmethod
-    def unpack(cls, dt):
-        s = cStringIO.StringIO(dt)
-        id, flag, lquiz, lans, lauth, lex = struct.unpack('>HHHHHH', s.read(12))
+    def unpack(cls, dt, level=PARSE.ALL):
+        ''' level: sections to parse, see PARSE. those after are left empty. '''
+        id, flag, lquiz, lans, lauth, lex = struct.unpack_from('>HHHHHH', dt)
         rec = cls(id, *unpackflag(flag))
-        rec.buf = dt
-        rec.quiz = [rec.unpackquiz(s) for i in xrange(lquiz)]
-        rec.ans = [rec.unpackRR(s) for i in xrange(lans)]
-        rec.auth = [rec.unpackRR(s) for i in xrange(lauth)]
-        rec.ex = [rec.unpackRR(s) for i in xrange(lex)]
+        rec.buf, rec.names = dt, {}
+        if level == PARSE.HEADER: return rec
+        off = 12
+        for i in xrange(lquiz):
+            q, off = rec.unpackquiz(off)
+            rec.quiz.append(q)
+        sections = [(rec.ans, lans)]
+        if level == PARSE.ALL: sections.extend([(rec.auth, lauth), (rec.ex, lex)])
+        for rrs, count in sections:
+            for i in xrange(count):
+                rr, off = rec.unpackRR(off)
+                rrs.append(rr)
         return rec
 
 def mkquery(*ntlist):
-    rec = Record(random.randint(0, 65536), 0, OPCODE.QUERY, 0, 0, 1, 0, 0)
+    rec = Record(random.randint(0, 0xffff), 0, OPCODE.QUERY, 0, 0, 1, 0, 0)
     for name, type in ntlist: rec.quiz.append((name, type, CLASS.IN))
     return rec
 
@@ -4,9 +4,14 @@
 @date: 2012-09-26
 @author: shell.xu
 '''
-import sys, random, struct, logging
+import os, sys, mmap, random, struct, bisect, getopt, hashlib, logging, itertools
+from os import path
+from array import array
 from gevent import socket
 
+try: import numpy
+except ImportError: numpy = None
+
 logger = logging.getLogger('netfilter')
 
 def get_netaddr(ip, mask):
@@ -19,13 +24,122 @@ def makemask(num):
         s |= i<num
     return struct.pack('>L', s)
 
+def ip2int(addr): return struct.unpack('>L', addr)[0]
+
+def range2cidr(start, end):
+    while start <= end:
+        size = start & -start or 0x100000000
+        while start + size - 1 > end: size >>= 1
+        yield start, size
+        start += size
+
+def ip6int(addr):
+    hi, lo = struct.unpack('>QQ', addr)
+    return hi << 64 | lo
+
+def int2ip6(n): return struct.pack('>QQ', n >> 64, n & 0xffffffffffffffff)
+
+def parseaddr(addr):
+    ''' return (is ipv6, packed address) of an ip string or a packed one.
+    text goes first, '1::1' is ipv6, not 4 packed bytes. '''
+    if ':' in addr:
+        try: return True, socket.inet_pton(socket.AF_INET6, addr)
+        except (socket.error, ValueError, TypeError): pass # packed, with nul
+    if len(addr) == 16: return True, addr
+    if len(addr) == 4: return False, addr
+    return False, socket.inet_aton(addr)
+
+def commonlen(k1, k2, l):
+    d = k1 ^ k2
+    return min(128 - d.bit_length(), l)
+
+class PrefixTrie(object):
+    ''' path compressed binary trie for ipv6 prefixes.
+    node: [key, prefix length, terminal, child0, child1] '''
+
+    def __init__(self): self.root = None
+
+    def insert(self, key, plen):
+        node, parent, i = self.root, None, 0
+        while node is not None:
+            c = commonlen(key, node[0], min(plen, node[1]))
+            if c < node[1]:
+                if c == plen: new = [key, plen, True, None, None]
+                else:
+                    new = [key >> (128 - c) << (128 - c), c, False, None, None]
+                    new[3 + (key >> (127 - c) & 1)] = [key, plen, True, None, None]
+                    new[3 + (node[0] >> (127 - c) & 1)] = node
+                break
+            if node[2]: return
+            if plen == node[1]:
+                node[2], node[3], node[4] = True, None, None
+                return
+            parent, i = node, 3 + (key >> (127 - node[1]) & 1)
+            node = node[i]
+        else: new = [key, plen, True, None, None]
+        if parent is None: self.root = new
+        else: parent[i] = new
+
+    def build(self, prefixes):
+        ''' bulk load, skip prefixes covered by an earlier one. '''
+        last = None
+        for key, plen in sorted(prefixes):
+            if last is not None and commonlen(key, last[0], last[1]) == last[1]:
+                continue
+            self.insert(key, plen)
+            last = (key, plen)
+
+    def __contains__(self, key):
+        node = self.root
+        while node is not None:
+            if commonlen(key, node[0], node[1]) < node[1]: return False
+            if node[2]: return True
+            node = node[3 + (key >> (127 - node[1]) & 1)]
+        return False
+
+    def __iter__(self):
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            if node[2]: yield node[0], node[1]
+            stack.extend([n for n in (node[4], node[3]) if n is not None])
+
+BINMAGIC = 'NFR3'
+BINHEADER = struct.Struct('<4sII16s') # magic, ranges, ipv6 prefixes, md5 of sources
+BINPREFIX6 = struct.Struct('<16sB')
+
 class NetFilter(object):
 
-    def __init__(self, *filenames):
-        self.nets = {}
+    def __init__(self, *filenames, **kw):
+        self.nets, self.base = {}, (array('I'), array('I'))
+        self.nets6, self.base6 = set(), []
+        self.starts, self.ends, self.trie6 = None, None, None
+        self.digest = self.srcdigest(filenames)
+        cache = kw.get('cache')
+        if cache and path.exists(cache) and self.loadbinary(cache, self.digest):
+            return
         for filename in filenames: self.loadfile(filename)
+        if cache: self.compile(cache)
+
+    @staticmethod
+    def srcdigest(filenames):
+        ''' md5 of source files, a compiled cache is fresh if it is of the same.
+        mtime is not enough, an upgraded package may keep the old one. '''
+        h = hashlib.md5()
+        for filename in filenames:
+            try:
+                with open(filename, 'rb') as fi: h.update(fi.read())
+            except (OSError, IOError): pass
+        return h.digest()
 
     def loadline(self, line):
+        if line.find(':') != -1:
+            addr, plen = line.split('/', 1) if '/' in line else (line, 128)
+            plen = int(plen)
+            key = ip6int(socket.inet_pton(socket.AF_INET6, addr.strip()))
+            self.nets6.add((key >> (128 - plen) << (128 - plen), plen))
+            self.starts = None
+            return
         if line.find(' ') != -1:
             addr, mask = line.split(' ', 1)
             addr, mask = socket.inet_aton(addr), socket.inet_aton(mask)
@@ -34,9 +148,29 @@ class NetFilter(object):
             addr, mask = socket.inet_aton(addr), makemask(int(mask))
         self.nets.setdefault(mask, set())
         self.nets[mask].add(get_netaddr(addr, mask))
+        self.starts = None
 
     def load(self, stream):
         for line in stream: self.loadline(line.strip())
+        self.build()
+
+    def build(self):
+        ''' merge all networks into sorted, disjoint [start, end] ranges. '''
+        r = zip(*self.base)
+        for mask, addrs in self.nets.iteritems():
+            size = ~ip2int(mask) & 0xffffffff
+            r.extend([(ip2int(addr), ip2int(addr) + size) for addr in addrs])
+        r.sort()
+        starts, ends = array('I'), array('I')
+        for start, end in r:
+            if ends and start <= ends[-1] + 1:
+                if end > ends[-1]: ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        self.trie6 = PrefixTrie()
+        self.trie6.build(self.nets6.union(self.base6))
+        self.starts, self.ends = starts, ends
 
     def loadfile(self, filename):
         openfile = open
@@ -47,12 +181,76 @@ class NetFilter(object):
             with openfile(filename) as fi: self.load(fi)
         except (OSError, IOError): return False
 
+    def compile(self, filepath):
+        ''' write merged ranges as little endian uint32 arrays, loadable by mmap. '''
+        if self.starts is None: self.build()
+        starts, ends = self.starts, self.ends
+        if sys.byteorder != 'little':
+            starts, ends = array('I', starts), array('I', ends)
+            starts.byteswap()
+            ends.byteswap()
+        prefixes6 = list(self.trie6)
+        tmppath = filepath + '.tmp'
+        try:
+            if path.dirname(filepath) and not path.isdir(path.dirname(filepath)):
+                os.makedirs(path.dirname(filepath))
+            with open(tmppath, 'wb') as fo:
+                fo.write(BINHEADER.pack(BINMAGIC, len(starts), len(prefixes6), self.digest))
+                fo.write(starts.tostring())
+                fo.write(ends.tostring())
+                for key, plen in prefixes6:
+                    fo.write(BINPREFIX6.pack(int2ip6(key), plen))
+            os.rename(tmppath, filepath)
+        except (OSError, IOError):
+            logger.warn('compile netfilter to %s failed' % filepath)
+            return False
+        return True
+
+    def loadbinary(self, filepath, digest=None):
+        ''' load ranges compiled, merged and sorted already.
+        return False if it is not compiled from sources of digest. '''
+        try:
+            with open(filepath, 'rb') as fi:
+                mm = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, IOError, ValueError): return False
+        try:
+            if mm.size() < BINHEADER.size: return False
+            magic, count, count6, srcdigest = BINHEADER.unpack(mm[:BINHEADER.size])
+            off6 = BINHEADER.size + 8 * count
+            if magic != BINMAGIC or mm.size() != off6 + BINPREFIX6.size * count6:
+                logger.warn('%s is not a compiled netfilter' % filepath)
+                return False
+            if digest is not None and digest != srcdigest:
+                logger.info('%s is out of date' % filepath)
+                return False
+            starts, ends = array('I'), array('I')
+            starts.fromstring(mm[BINHEADER.size:BINHEADER.size + 4 * count])
+            ends.fromstring(mm[BINHEADER.size + 4 * count:off6])
+            base6 = []
+            for i in xrange(off6, mm.size(), BINPREFIX6.size):
+                addr, plen = BINPREFIX6.unpack_from(mm, i)
+                base6.append((ip6int(addr), plen))
+        finally: mm.close()
+        if sys.byteorder != 'little':
+            starts.byteswap()
+            ends.byteswap()
+        self.base, self.base6 = (starts, ends), base6
+        self.starts, self.ends = starts, ends
+        self.trie6 = PrefixTrie()
+        self.trie6.build(base6)
+        return True
+
     def save(self, stream):
         r = []
         for mask, addrs in self.nets.iteritems():
             r.extend([(addr, mask) for addr in list(addrs)])
+        for start, end in zip(*self.base):
+            r.extend([(struct.pack('>L', addr), struct.pack('>L', ~(size - 1) & 0xffffffff))
+                      for addr, size in range2cidr(start, end)])
         for addr, mask in sorted(r, key=lambda x: x[0]):
             stream.write('%s %s\n' % (socket.inet_ntoa(addr), socket.inet_ntoa(mask)))
+        for key, plen in sorted(self.nets6.union(self.base6)):
+            stream.write('%s/%d\n' % (socket.inet_ntop(socket.AF_INET6, int2ip6(key)), plen))
 
     def savefile(self, filepath):
         openfile = open
@@ -64,14 +262,74 @@ class NetFilter(object):
         except (OSError, IOError): return False
 
     def __contains__(self, addr):
-        try: addr = socket.inet_aton(addr)
-        except TypeError: pass
-        for mask, addrs in self.nets.iteritems():
-            if get_netaddr(addr, mask) in addrs: return True
-        return False
+        if self.starts is None: self.build()
+        v6, addr = parseaddr(addr)
+        if v6: return ip6int(addr) in self.trie6
+        return self.ipint_in(ip2int(addr))
+
+    def ipint_in(self, ip):
+        i = bisect.bisect_right(self.starts, ip) - 1
+        return i >= 0 and ip <= self.ends[i]
+
+    def contains_many(self, addresses):
+        ''' classify addresses in bulk.
+        addresses can be ip strings, packed addresses or uint32 integers,
+        or a numpy integer array. return a numpy bool array,
+        or a list of bool when numpy not installed. '''
+        if self.starts is None: self.build()
+        if numpy is not None and isinstance(addresses, numpy.ndarray):
+            return self.searchsorted(addresses.astype(numpy.uint32))
+        addresses, ips, v6 = list(addresses), [], []
+        for i, addr in enumerate(addresses):
+            if isinstance(addr, (int, long)):
+                ips.append(addr)
+                continue
+            isv6, addr = parseaddr(addr)
+            if isv6:
+                ips.append(0)
+                v6.append((i, addr))
+            else: ips.append(ip2int(addr))
+        if numpy is None: r = map(self.ipint_in, ips)
+        else: r = self.searchsorted(numpy.array(ips, numpy.uint32))
+        for i, addr in v6: r[i] = ip6int(addr) in self.trie6
+        return r
+
+    def searchsorted(self, ips):
+        if not self.starts: return numpy.zeros(len(ips), bool)
+        starts = numpy.asarray(self.starts, numpy.uint32)
+        ends = numpy.asarray(self.ends, numpy.uint32)
+        idx = numpy.searchsorted(starts, ips, 'right') - 1
+        return (idx >= 0) & (ips <= ends[numpy.maximum(idx, 0)])
 
 def main():
-    nf = NetFilter(sys.argv[1])
-    for i in sys.argv[2:]: print '%s: %s' % (i, i in nf)
+    '''
+    netfilter.py filename ip...: check ips in filter.
+    netfilter.py -c output filename...: compile filters into binary file.
+    netfilter.py -m ipfile filename...: classify every ip in ipfile, - for stdin.
+    -h: help
+    '''
+    optlist, args = getopt.getopt(sys.argv[1:], 'c:m:h')
+    optdict = dict(optlist)
+    if '-h' in optdict:
+        print main.__doc__
+        return
+    if '-c' in optdict:
+        nf = NetFilter(*args)
+        nf.compile(optdict['-c'])
+        print '%d ranges compiled' % len(nf.starts)
+        return
+    if '-m' in optdict:
+        nf = NetFilter(*args)
+        fi = sys.stdin if optdict['-m'] == '-' else open(optdict['-m'])
+        try:
+            while True:
+                ips = [line.strip() for line in itertools.islice(fi, 65536)]
+                if not ips: break
+                ips = [ip for ip in ips if ip]
+                for ip, r in zip(ips, nf.contains_many(ips)): print '%s: %s' % (ip, r)
+        finally: fi.close()
+        return
+    nf = NetFilter(args[0])
+    for i in args[1:]: print '%s: %s' % (i, i in nf)
 
 if __name__ == '__main__': main()
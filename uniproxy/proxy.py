@@ -6,7 +6,7 @@
 '''
 import os, copy, time, base64, logging
 import conn
-from gevent import select
+from gevent import select, socket
 from http import *
 
 logger = logging.getLogger('proxy')
@@ -45,12 +45,13 @@ def fdcopy(fd1, fd2):
 def connect(req, sock_factory, timeout=None):
     hostname, port, uri = parse_target(req.url)
     try:
-        with sock_factory.socket() as sock:
-            sock.connect((hostname, port))
+        sock, reused = sock_factory.acquire((hostname, port), fresh=True)
+        try:
             res = HttpResponse(req.version, 200, 'OK')
             res.send_header(req.stream)
             req.stream.flush()
             fdcopy(req.stream.fileno(), sock.fileno())
+        finally: sock_factory.release((hostname, port), sock)
     finally: logger.info('%s closed' % req.uri)
 
 def streamcopy(msg, stream1, stream2, tout, hasbody=False):
@@ -60,6 +61,26 @@ def streamcopy(msg, stream1, stream2, tout, hasbody=False):
         while True: ouf(inf())
     except StopIteration, err: return
 
+def keepalive(msg):
+    c = msg.get_header('Connection', '').lower()
+    if msg.version.upper() == 'HTTP/1.1': return c != 'close'
+    return c == 'keep-alive'
+
+def reusable(reqx, res, hasbody):
+    ''' the origin connection is kept and clean after the response,
+    whose end is known not by closing. '''
+    if res.code < 200 or not keepalive(reqx) or not keepalive(res): return False
+    return not hasbody or res.has_header('Content-Length') or\
+        res.get_header('Transfer-Encoding', 'identity') != 'identity'
+
+def send_request(reqx, req, sock, tout):
+    stream1 = sock.makefile()
+    if VERBOSE: req.debug()
+    tout(reqx.send_header)(stream1)
+    streamcopy(reqx, req.stream, stream1, tout)
+    stream1.flush()
+    return stream1, recv_msg(stream1, HttpResponse)
+
 def http(req, sock_factory, timeout=None):
     t = time.time()
     tout = conn.set_timeout(timeout)
@@ -67,24 +88,37 @@ def http(req, sock_factory, timeout=None):
     reqx = copy.copy(req)
     reqx.uri = uri
     reqx.headers = [(h, v) for h, v in req.headers if not h.startswith('Proxy')]
-    with sock_factory.socket() as sock:
-        sock.connect((hostname, port))
-        stream1 = sock.makefile()
-
-        if VERBOSE: req.debug()
-        tout(reqx.send_header)(stream1)
-        streamcopy(reqx, req.stream, stream1, tout)
-        stream1.flush()
+    addr, reuse = (hostname, port), False
+    sock, reused = sock_factory.acquire(addr)
+    try:
+        t1 = time.time()
+        try: stream1, res = send_request(reqx, req, sock, tout)
+        except (EOFError, socket.error):
+            # origin closed the idle connection as we reused it, send again
+            # if the request body has not been read.
+            if not reused or reqx.has_header('Content-Length') or\
+                    reqx.has_header('Transfer-Encoding'): raise
+            logger.debug('%s:%d idle connection closed, retry' % addr)
+            sock_factory.release(addr, sock)
+            sock = None
+            sock, reused = sock_factory.acquire(addr, fresh=True)
+            t1 = time.time()
+            stream1, res = send_request(reqx, req, sock, tout)
+        # failures here are mostly of the origin, they are not reported.
+        if isinstance(sock_factory, conn.Health):
+            sock_factory.report(ttfb=time.time() - t1)
 
-        res = recv_msg(stream1, HttpResponse)
         if VERBOSE: res.debug()
         tout(res.send_header)(req.stream)
         hasbody = req.method.upper() != 'HEAD' and res.code not in CODE_NOBODY
-        streamcopy(res, stream1, req.stream, tout, hasbody)
+        if hasbody: streamcopy(res, stream1, req.stream, tout, hasbody)
         req.stream.flush()
+        reuse = reusable(reqx, res, hasbody)
+    finally:
+        if sock is not None: sock_factory.release(addr, sock, reuse)
     res.connection = req.get_header('Proxy-Connection', '').lower() == 'keep-alive' and\
         res.get_header('Connection', 'close').lower() != 'close'
-    logger.debug('%s with %d in %0.2f, %s' % (
+    logger.debug('%s with %d in %0.2f, %s%s' % (
             req.uri.split('?', 1)[0], res.code, time.time() - t,
-            'keep' if res.connection else 'close'))
+            'keep' if res.connection else 'close', ', reused' if reused else ''))
     return res
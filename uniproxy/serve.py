@@ -4,12 +4,12 @@
 @date: 2012-04-26
 @author: shell.xu
 '''
-import time, base64, logging
+import time, base64, random, logging
 import socks, proxy, conn, hoh, dnsserver, dofilter, netfilter
 from os import path
 from urlparse import urlparse
 from contextlib import contextmanager
-from gevent import dns, socket, Timeout
+from gevent import socket, Timeout
 from http import *
 
 __all__ = ['ProxyServer',]
@@ -35,10 +35,31 @@ def fmt_reqinfo(info):
     req, usesocks, addr, t, name = info
     return '%s %s %s' % (req.method, req.uri.split('?', 1)[0], name)
 
+class RouteCache(object):
+    ''' lru cache of routing decisions by hostname, expired with dns ttl. '''
+    TIMEOUT = 300
+
+    def __init__(self, size=1024):
+        self.cache, self.size = dnsserver.LRUCache(size), size
+        self.hit, self.miss = 0, 0
+
+    def get(self, hostname):
+        r = self.cache.get(hostname)
+        if r is not None: self.hit += 1
+        else: self.miss += 1
+        return r
+
+    def set(self, hostname, expire, usesocks):
+        self.cache.set(hostname, usesocks, expire)
+
+    def stat(self):
+        return '%d/%d hit %d miss %d' % (len(self.cache), self.size, self.hit, self.miss)
+
 class ProxyServer(object):
     env = {'socks5': socks.SocksManager, 'http': conn.HttpManager,
            'DomainFilter': dofilter.DomainFilter,
            'NetFilter': netfilter.NetFilter, 'DNSServer': dnsserver.DNSServer,
+           'TCPDNSServer': dnsserver.TCPDNSServer,
            'HttpOverHttp': hoh.HttpOverHttp, 'GAE': hoh.GAE}
     srv_urls = {}
 
@@ -58,6 +79,7 @@ class ProxyServer(object):
         raise Exception('unknown ssh define')
         
     def loadconfig(self):
+        if self.dns is not None: self.dns.final()
         self.config = import_config(self.cfgs, self.env)
         self.proxy_auth = proxy.get_proxy_auth(self.config.get('users'))
 
@@ -75,6 +97,7 @@ class ProxyServer(object):
         self.whitenf = self.config.get('whitenets')
         self.blacknf = self.config.get('blacknets')
         self.direct = conn.DirectManager(self.dns)
+        self.routes = RouteCache(self.config.get('route_cache', 1024))
 
         self.func_connect = conn.set_timeout(self.config.get('conn_tout'))(proxy.connect)
         self.func_http = conn.set_timeout(self.config.get('http_tout'))(proxy.http)
@@ -93,22 +116,41 @@ class ProxyServer(object):
         finally: self.worklist.remove(reqinfo)
 
     def get_conn_mgr(self, direct):
+        ''' power of two choices among proxies not ejected, by expected time
+        of a request, times connections in use, idle ones not counted. '''
         if direct: return self.direct
-        return min(self.proxies, key=lambda x: x.size())
-
-    def usesocks(self, hostname, req):
+        proxies = [p for p in self.proxies if not p.ejected()] or self.proxies
+        if len(proxies) > 2: proxies = random.sample(proxies, 2)
+        mgr = min(proxies, key=lambda x: x.score() * (1 + x.size() - x.nidle))
+        mgr.picked()
+        return mgr
+
+    def route(self, hostname):
+        ''' return expire time and usesocks of hostname, expired with the
+        ttl of its address. expire is None when it should not be cached. '''
+        t = time.time()
+        expire = t + RouteCache.TIMEOUT
         if self.dofilter and hostname in self.dofilter:
-            return True
-        if self.whitenf is not None or self.blacknf is not None:
-            addr = self.dns.gethostbyname(hostname)
-            if req: req.address = addr
-            if addr is None: return False
-            logger.debug('hostname: %s, addr: %s' % (hostname, addr))
-            if self.whitenf is not None and addr in self.whitenf:
-                return True
-            if self.blacknf is not None and addr not in self.blacknf:
-                return True
-        return False
+            return expire, True
+        if self.whitenf is None and self.blacknf is None:
+            return expire, False
+        addr = self.dns.gethostbyname(hostname)
+        if addr is None: return None, False
+        logger.debug('hostname: %s, addr: %s' % (hostname, addr))
+        r = self.dns.cache.get((hostname, dnsserver.TYPE.A))
+        if r is not None: expire = r[5] if r[5] > t else None
+        if self.whitenf is not None and addr in self.whitenf:
+            return expire, True
+        if self.blacknf is not None and addr not in self.blacknf:
+            return expire, True
+        return expire, False
+
+    def usesocks(self, hostname):
+        usesocks = self.routes.get(hostname)
+        if usesocks is None:
+            expire, usesocks = self.route(hostname)
+            if expire is not None: self.routes.set(hostname, expire, usesocks)
+        return usesocks
 
     def do_req(self, req, addr):
         authres = self.proxy_auth(req)
@@ -130,7 +172,7 @@ class ProxyServer(object):
         else:
             hostname, func, tout = (
                 req.url.netloc, self.func_http, self.config.get('http_noac'))
-        usesocks = self.usesocks(hostname.split(':', 1)[0], req)
+        usesocks = self.usesocks(hostname.split(':', 1)[0])
         reqinfo = [req, usesocks, addr, time.time(), '']
 
         # if usesocks and self.upstream:
@@ -150,6 +192,10 @@ class ProxyServer(object):
             try: return func(req, self.get_conn_mgr(not usesocks), tout)
             except Timeout, err:
                 logger.warn('connection timeout: %s' % req.uri)
+            except conn.Overload, err:
+                logger.warn('%s: %s' % (err, req.uri))
+                response_http(503, body='Proxy overloaded').sendto(req.stream)
+                req.stream.flush()
 
     def http_handler(self, sock, addr):
         stream = sock.makefile()
@@ -161,4 +207,6 @@ class ProxyServer(object):
             sock.close()
             logger.debug('browser connection closed')
 
-    def final(self): logger.info('system exit')
+    def final(self):
+        if self.dns is not None: self.dns.final()
+        logger.info('system exit')
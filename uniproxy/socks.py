@@ -4,9 +4,9 @@
 @date: 2010-06-04
 @author: shell.xu
 '''
-import sys, struct, getopt, logging, conn
+import sys, time, struct, getopt, logging, gevent, conn
 from contextlib import contextmanager
-from gevent import socket, coros
+from gevent import socket, select, Timeout
 
 __all__ = ['SocksManager',]
 logger = logging.getLogger('socks')
@@ -19,6 +19,7 @@ def fmt_string(data): return chr(len(data)) + data
 class GeneralProxyError(socket.error):
     __ERRORS =("success", "invalid data", "not connected", "not available", "bad proxy type", "bad input")
     def __init__(self, id, *params):
+        self.code = id
         if id in self.__ERRORS: params.insert(0, self.__ERRORS[id])
         super(GeneralProxyError, self).__init__(*params)
 
@@ -90,22 +91,91 @@ def socks5_connect(sock, target, rdns=True):
     logger.debug('socks connected with %s:%s' % target)
     return boundaddr, boundport
 
-def socks5(proxyaddr, username=None, password=None, rdns=True):
+def socks5_target(sock, rdns=True):
+    def newconn(addr): socks5_connect(sock, addr, rdns)
+    sock.connect, sock.connect_ex = newconn, newconn
+    return sock
+
+def socks5_greeted(proxyaddr, username=None, password=None):
     def reciver(func):
         def creator(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
             sock = func(family, type, proto)
-            socks5_create(sock, proxyaddr, username, password)
-            def newconn(addr): socks5_connect(sock, addr, rdns)
-            sock.connect, sock.connect_ex = newconn, newconn
+            try: socks5_create(sock, proxyaddr, username, password)
+            except:
+                sock.close()
+                raise
             return sock
         return creator
     return reciver
 
+def socks5(proxyaddr, username=None, password=None, rdns=True):
+    def reciver(func):
+        greeted = socks5_greeted(proxyaddr, username, password)(func)
+        def creator(family=socket.AF_INET, type=socket.SOCK_STREAM, proto=0):
+            return socks5_target(greeted(family, type, proto), rdns)
+        return creator
+    return reciver
+
 class SocksManager(conn.Manager):
+    ''' warm sockets have done greeting and auth, and wait for connect.
+    they take room of max_conn as other connections to the proxy, and are
+    filled again in background after taken, or when a connection is freed. '''
 
     def __init__(self, addr, port, username=None, password=None,
-                 rdns=True, max_conn=10, name=None, ssl=False, **kargs):
+                 rdns=True, max_conn=10, name=None, ssl=False, warm=2, **kargs):
         super(SocksManager, self).__init__(max_conn, name or 'socks5:%s:%s' % (addr, port))
         if ssl is True: self.creator = conn.ssl_socket()(self.creator)
         elif ssl: self.creator = conn.ssl_socket(ssl)(self.creator)
-        self.creator = socks5((addr, port), username, password, rdns)(self.creator)
+        self.greet = socks5_greeted((addr, port), username, password)(self.creator)
+        self.rdns, self.warm, self.warmed, self.filling = rdns, warm, [], 0
+        self.warm_hit, self.warm_miss = 0, 0
+        self.creator = self.create
+
+    def stat(self):
+        return '%s warm %d hit %d miss %d' % (
+            super(SocksManager, self).stat(), len(self.warmed),
+            self.warm_hit, self.warm_miss)
+
+    def create(self, *p):
+        t = time.time() - self.IDLE
+        while self.warmed:
+            st, sock = self.warmed.pop()
+            # readable means closed by proxy.
+            if st > t and not select.select([sock], [], [], 0)[0]:
+                self.warm_hit += 1
+                break
+            sock.close()
+        else:
+            self.warm_miss += 1
+            sock = None
+        self.refill()
+        if sock is None: sock = self.greet(*p)
+        return socks5_target(sock, self.rdns)
+
+    def failed(self, err):
+        # other replies are of the target, unreachable, refused and so on.
+        if isinstance(err, Socks5Error): return err.code == 1
+        return super(SocksManager, self).failed(err)
+
+    def free(self):
+        super(SocksManager, self).free()
+        self.refill()
+
+    def room(self): return min(self.warm, self.max_conn - self.size())
+
+    def refill(self):
+        for i in xrange(self.room() - len(self.warmed) - self.filling):
+            self.filling += 1
+            gevent.spawn(self.fill)
+
+    def fill(self):
+        try:
+            # the room may be taken before we run, by a waiter for example.
+            if len(self.warmed) + self.filling > self.room(): return
+            with Timeout(self.CONNECT): sock = self.greet()
+        except (Exception, Timeout), err:
+            logger.debug('%s warm failed: %s' % (self.name, err))
+            return
+        finally: self.filling -= 1
+        if len(self.warmed) >= self.room(): sock.close()
+        else: self.warmed.append((time.time(), sock))